@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+from challenge import compute_task
+from classes.ElasticConnection import ElasticConnection, AsyncElasticConnection
+from classes.SchemaSnapshot import SchemaSnapshot, write_snapshot
+from classes.URIDictionary import URIDictionary
+from index_dbpedia import calculate_idf
+from utilities import settings
+from utilities.Configuration import Configuration
+from utilities.graph import bfs, longest_paths
+
+ONTOLOGY = "http://dbpedia.org/ontology/"
+RESOURCE = "http://dbpedia.org/resource/"
+
+# Fixture ontology, each class with its direct superclasses
+CLASSES = {
+    "Agent": (), "Person": ("Agent",), "Athlete": ("Person",), "Artist": ("Person",),
+    "Organisation": ("Agent",), "Company": ("Organisation",),
+    "Place": (), "PopulatedPlace": ("Place",), "City": ("PopulatedPlace",), "Country": ("PopulatedPlace",),
+    "Work": (), "Film": ("Work",), "Album": ("Work",),
+}
+
+# Property that links the resources of a class to those of another one
+PROPERTIES = {
+    "Athlete": ("birthPlace", "City"), "Artist": ("birthPlace", "City"), "Company": ("location", "Country"),
+    "City": ("country", "Country"), "Film": ("director", "Artist"), "Album": ("artist", "Artist"),
+}
+
+WORDS = ("north", "river", "silver", "grand", "stone", "maple", "harbor", "crystal", "iron", "golden", "lake",
+         "valley", "royal", "summit", "ocean", "forest", "eagle", "bright", "cedar", "falcon", "meadow", "copper",
+         "willow", "crown", "amber", "storm", "ridge", "haven", "pine", "star")
+
+
+def build_resources(entities, seed):
+    """
+    :param entities: number of resources of each class in PROPERTIES and Country
+    :return: dictionary with the source document of each resource uri, grouped by class
+    """
+    rng = random.Random(seed)
+    resources = {}
+    for c in sorted(set(PROPERTIES) | {"Country"}):
+        resources[c] = {}
+        for i in range(entities):
+            label = " ".join(rng.choice(WORDS) for _ in range(2)) + f" {c.lower()} {i}"
+            uri = RESOURCE + label.title().replace(" ", "_")
+            resources[c][uri] = {
+                "uri": uri,
+                "labels": [label.title()],
+                "types": [ONTOLOGY + t for t in (c,) + ancestors(c)],
+                "categories": [RESOURCE + f"Category:{c}s_of_{rng.choice(WORDS).title()}"],
+                "objects": [],
+                "disam": [],
+            }
+    for c, (p, target) in PROPERTIES.items():
+        targets = sorted(resources[target])
+        for document in resources[c].values():
+            document["objects"] = [[ONTOLOGY + p, [rng.choice(targets)]]]
+    return resources
+
+
+def ancestors(c):
+    found = ()
+    for s in CLASSES[c]:
+        found += (s,) + ancestors(s)
+    return found
+
+
+class FakeSearchClient:
+    """
+    Stand-in for the Elasticsearch client of an ElasticConnection. Searches and _msearch requests are answered
+    from the synthetic resources by the overlap between the query keywords and their labels, so the results are
+    deterministic. Every request waits latency seconds.
+    """
+    def __init__(self, resources, latency=0.0):
+        self.latency = latency
+        self.documents = [d for documents in resources.values() for d in documents.values()]
+        self.tokens = {}
+        for i, document in enumerate(self.documents):
+            for token in set(document["labels"][0].lower().split()):
+                self.tokens.setdefault(token, set()).add(i)
+
+    def search(self, index, body, size, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return {"hits": {"hits": self.hits(body, size)}}
+
+    def msearch(self, body, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return {"responses": [{"hits": {"hits": self.hits(query, query["size"])}} for query in body[1::2]]}
+
+    def hits(self, body, size):
+        keywords, related, types = self._parse(body)
+        query = set(str(keywords).lower().split())
+        scores = Counter()
+        for token in query:
+            for i in self.tokens.get(token, ()):
+                scores[i] += 1
+        hits = []
+        for i, overlap in scores.items():
+            document = self.documents[i]
+            if types and not set(types) & set(document["types"]):
+                continue
+            label = document["labels"][0].lower()
+            score = 10 * overlap / len(set(label.split()) | query) + (5 if label == str(keywords).lower() else 0)
+            if document["uri"] in related:
+                score += 2
+            if score >= 1.0:
+                hits.append({"_id": document["uri"], "_score": score, "_source": document})
+        hits.sort(key=lambda h: (-h["_score"], h["_id"]))
+        return hits[:size]
+
+    @staticmethod
+    def _parse(body):
+        """Returns the keywords, related uris and types of a phrase, combined or combined2 search body."""
+        query = body["query"]
+        if "dis_max" in query:
+            queries = query["dis_max"]["queries"]
+            return queries[1]["match"]["labels"], set(queries[2]["terms"]["uri.keyword"]), ()
+        must = query["bool"]["must"]
+        labels = must[0]["match"]["labels"]
+        if isinstance(labels, dict):
+            return labels["query"], set(must[1]["terms"]["uri.keyword"]), ()
+        return labels, set(), must[1]["terms"]["types.keyword"]
+
+
+class FakeAsyncSearchClient:
+    def __init__(self, client):
+        self.client = client
+
+    async def search(self, index, body, size, **kwargs):
+        if self.client.latency:
+            await asyncio.sleep(self.client.latency)
+        return {"hits": {"hits": self.client.hits(body, size)}}
+
+    async def close(self):
+        pass
+
+
+class FakeElasticConnection(ElasticConnection):
+    """ElasticConnection whose requests are answered by a FakeSearchClient, the rest of the class is unchanged."""
+    def __init__(self, resources, latency=0.0):
+        super().__init__("localhost", 9200)
+        self.es = FakeSearchClient(resources, latency)
+
+    def async_connection(self, max_in_flight):
+        connection = AsyncElasticConnection(self.host, self.port, max_in_flight, self)
+        connection.es = FakeAsyncSearchClient(self.es)
+        return connection
+
+
+def write_fixtures(path, resources):
+    """Writes the ontology snapshot, the uri dictionary and the IDF arrays used by compute_task."""
+    superclasses = {ONTOLOGY + c: [ONTOLOGY + s for s in supers] for c, supers in CLASSES.items()}
+    depths = longest_paths(superclasses, superclasses)
+    adjacency = {c: set() for c in superclasses}
+    for c, supers in superclasses.items():
+        for s in supers:
+            adjacency[c].add(s)
+            adjacency[s].add(c)
+    documents = [d for documents in resources.values() for d in documents.values()]
+    idf = {}
+    for field in ("categories", "types"):
+        idf[field] = calculate_idf(Counter(v for d in documents for v in d[field]))
+    write_snapshot(os.path.join(path, "snapshot"), superclasses, depths, {
+        "max_depth": max(depths.values()),
+        "diameter": max(max(bfs(adjacency, c).values()) for c in adjacency),
+        "max_idf": max(idf["types"].values()),
+    })
+    dictionary = URIDictionary(list(idf["categories"]) + list(idf["types"]))
+    os.makedirs(os.path.join(path, "dbpedia-example"), exist_ok=True)
+    dictionary.save(os.path.join(path, "dbpedia-example", "uri_dictionary.mp.lz4"))
+    np.save(os.path.join(path, "dbpedia-example", "categories_idf.npy"), dictionary.idf_array(idf["categories"].items()))
+    np.save(os.path.join(path, "dbpedia-example", "types_idf.npy"), dictionary.idf_array(idf["types"].items()))
+
+
+def write_tables(path, resources, tables, rows, columns, noise, named, seed):
+    """
+    Writes SemTab-style tables, whose first column has resources of a class and the second the resources linked to
+    them, followed by literal columns, and the column files of the three tasks.
+    :param named: fraction of the tables named after a resource, the others have digit-only names
+    :return: dictionary with the column file of each task
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(path, "tables"), exist_ok=True)
+    targets = {"cea": [], "cta": [], "cpa": []}
+    for t in range(tables):
+        subject = rng.choice(sorted(PROPERTIES))
+        # compute_task searches the part of the name before "#" and skips the search for digit-only names
+        if rng.random() < named:
+            label = resources[subject][rng.choice(sorted(resources[subject]))]["labels"][0]
+            name = f'{label.replace(" ", "_")}#{t}'
+        else:
+            name = f"{rng.randrange(10 ** 7, 10 ** 8)}{t:05d}"
+        lines = [",".join(f"col{c}" for c in range(columns))]
+        for _ in range(rows):
+            document = resources[subject][rng.choice(sorted(resources[subject]))]
+            linked = resources[PROPERTIES[subject][1]][document["objects"][0][1][0]]
+            cells = [_noisy(document["labels"][0], noise, rng), _noisy(linked["labels"][0], noise, rng)]
+            cells.extend(str(rng.randrange(1900, 2020)) for _ in range(columns - 2))
+            lines.append(",".join(f'"{c}"' for c in cells[:columns]))
+        with open(os.path.join(path, "tables", name + ".csv"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        targets["cta"].extend(f'"{name}","{c}"' for c in range(min(columns, 2)))
+        targets["cea"].extend(f'"{name}","{c}","{r}"' for c in range(min(columns, 2)) for r in range(1, rows + 1))
+        targets["cpa"].append(f'"{name}","0","1"')
+    files = {}
+    for task, lines in targets.items():
+        files[task] = os.path.join(path, f"{task}_targets.csv")
+        with open(files[task], "w") as f:
+            f.write("\n".join(lines) + "\n")
+    return files
+
+
+def _noisy(label, noise, rng):
+    if rng.random() >= noise:
+        return label
+    if rng.random() < 0.2:
+        return ""
+    i = rng.randrange(len(label))
+    return (label[:i] + label[i + 1:]).lower()
+
+
+def write_config(path, task, targets, batch_size, max_in_flight):
+    config = configparser.ConfigParser()
+    config["DEFAULT"] = {"homedir": path, "taskdir": os.path.join(path, "tables"), "taskcolumnfile": targets,
+                         "outdir": os.path.join(path, "out", task), "task": task,
+                         "metrics": os.path.join(path, "out", task, "metrics")}
+    config["Arangodb"] = {"snapshot": os.path.join(path, "snapshot")}
+    config["Elasticsearch"] = {"batchsize": str(batch_size), "maxinflight": str(max_in_flight)}
+    filename = os.path.join(path, f"{task}.cfg")
+    with open(filename, "w") as f:
+        config.write(f)
+    os.makedirs(os.path.join(path, "out", task), exist_ok=True)
+    return Configuration(filename)
+
+
+def run_task(config, task):
+    start = time.perf_counter()
+    compute_task(config, task)
+    seconds = time.perf_counter() - start
+    with open(config.metrics + ".json") as f:
+        report = json.load(f)
+    total = report["total"]
+    files = len(report["files"])
+    cells = total.get("counts", {}).get("cells", 0)
+    return {
+        "task": task,
+        "files": files,
+        "cells": cells,
+        "seconds": seconds,
+        "files_per_s": files / seconds,
+        "cells_per_s": cells / seconds,
+        # Kilobytes on Linux, the peak of the workers is the largest of all the workers reaped so far
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "stages": total.get("time", {}),
+        "calls": total.get("calls", {}),
+    }
+
+
+def print_result(result):
+    print(f'{result["task"]}: {result["files"]} files, {result["cells"]} cells in {result["seconds"]:.2f}s, '
+          f'{result["files_per_s"]:.1f} files/s, {result["cells_per_s"]:.0f} cells/s, '
+          f'peak RSS {result["peak_rss_mb"]:.0f} MB (workers {result["peak_worker_rss_mb"]:.0f} MB)')
+    total = result["stages"].get("total", 0) or 1
+    for stage, seconds in sorted(result["stages"].items(), key=lambda kv: kv[1], reverse=True):
+        print(f'  {stage:<24} {seconds:9.3f}s {100 * seconds / total:6.1f}%  {result["calls"].get(stage, 0)} calls')
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main(args):
+    path = args.directory or tempfile.mkdtemp(prefix="adog-benchmark-")
+    try:
+        resources = build_resources(args.entities, args.seed)
+        write_fixtures(path, resources)
+        targets = write_tables(path, resources, args.tables, args.rows, args.columns, args.noise, args.named,
+                               args.seed)
+        settings.init()
+        settings.EC = FakeElasticConnection(resources, args.latency / 1000)
+        settings.GRAPH = SchemaSnapshot(os.path.join(path, "snapshot"))
+
+        results = []
+        for task in args.tasks:
+            config = write_config(path, task, targets[task], args.batch_size, args.max_in_flight)
+            results.append(run_task(config, task))
+        for result in results:
+            print_result(result)
+
+        if args.history:
+            with open(args.history, "a") as f:
+                f.write(json.dumps({"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                    "arguments": vars(args), "results": results}) + "\n")
+    finally:
+        if not args.directory:
+            shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Runs compute_task on synthetic tables with a fake Elasticsearch "
+                                                 "and a fixture ontology.")
+    PARSER.add_argument("-t", "--tables", type=int, default=20, help="Number of tables.")
+    PARSER.add_argument("-r", "--rows", type=int, default=50, help="Number of rows of each table.")
+    PARSER.add_argument("-cl", "--columns", type=int, default=3, help="Number of columns of each table.")
+    PARSER.add_argument("-e", "--entities", type=int, default=200, help="Number of resources of each class.")
+    PARSER.add_argument("-n", "--noise", type=float, default=0.1, help="Fraction of misspelled or empty cells.")
+    PARSER.add_argument("-na", "--named", type=float, default=0.25,
+                        help="Fraction of the tables named after a resource, whose name is searched.")
+    PARSER.add_argument("--tasks", nargs="+", default=["cea", "cta", "cpa"], choices=["cea", "cta", "cpa"])
+    PARSER.add_argument("-l", "--latency", type=float, default=0, help="Milliseconds added to each request.")
+    PARSER.add_argument("-b", "--batch-size", type=int, default=0, help="Queries per _msearch request.")
+    PARSER.add_argument("-m", "--max-in-flight", type=int, default=0, help="Concurrent queries with asyncio.")
+    PARSER.add_argument("-s", "--seed", type=int, default=0)
+    PARSER.add_argument("-d", "--directory", type=str, default="",
+                        help="Directory kept with the fixtures, tables and outputs, a temporary one by default.")
+    PARSER.add_argument("--history", type=str, default="", help="JSON lines file the results are appended to.")
+    main(PARSER.parse_args())
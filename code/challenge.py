@@ -1,20 +1,25 @@
 import argparse
+import asyncio
 import os
 import shutil
+from collections import defaultdict
 from multiprocessing.pool import Pool
+from multiprocessing.util import Finalize
 
 import numpy as np
 import pandas as pd
-from inpout import inpout
 from tqdm import tqdm
 
 from classes.ArangoSchemaGraph import ArangoSchemaGraph
 from classes.CSVDataSource import CSVDataSource
 from classes.ElasticConnection import ElasticConnection
-from helpers import match_column
-from utilities import settings
+from classes.SchemaSnapshot import SchemaSnapshot
+from classes.URIDictionary import URIDictionary
+from helpers import match_column, match_column_async
+from utilities import metrics, settings
 from utilities.Configuration import Configuration
-from utilities.general import levenshtein_similarity, clean_string
+from utilities.general import max_similarity, clean_frame
+from utilities.metrics import SamplingProfiler, Timer
 
 TASK = ""
 CELLS = None
@@ -22,9 +27,14 @@ CELLS = None
 
 def main(args):
     config = Configuration(args.config_file)
-    arango = ArangoSchemaGraph(config)
-    arango.init_graph()
+    if config.snapshot and os.path.exists(config.snapshot):
+        arango = SchemaSnapshot(config.snapshot)
+    else:
+        arango = ArangoSchemaGraph(config)
+        arango.init_graph()
     ec = ElasticConnection(config.ehost, config.eport)
+    if config.cache_file:
+        ec.enable_cache(config.cache_file, config.cache_size, config.cache_disk_size)
     settings.init()
     settings.EC = ec
     settings.GRAPH = arango
@@ -38,8 +48,11 @@ def compute_task(config, task):
     settings.GRAPH.uris()
     settings.GRAPH.hierarchy()
     settings.GRAPH.depths()
-    settings.CAT_IDF = dict(inpout.load_iter(config.base_dir + "dbpedia-example/categories_idf.mp.lz4"))
-    settings.TYPES_IDF = dict(inpout.load_iter(config.base_dir + "dbpedia-example/types_idf.mp.lz4"))
+    settings.URIS = URIDictionary.load(config.base_dir + "dbpedia-example/uri_dictionary.mp.lz4")
+    settings.CAT_IDF = np.load(config.base_dir + "dbpedia-example/categories_idf.npy")
+    settings.TYPES_IDF = np.load(config.base_dir + "dbpedia-example/types_idf.npy")
+    settings.BATCH_SIZE = config.batch_size
+    settings.MAX_IN_FLIGHT = config.max_in_flight
     if settings.PACT:
         if not os.path.exists(config.output_dir + "short/"):
             os.makedirs(config.output_dir + "short/")
@@ -66,10 +79,13 @@ def compute_task(config, task):
     CELLS.columns = ["file"] + columns
     files = CELLS["file"].unique()
     np.random.shuffle(files)
-    files_open = tuple(CSVDataSource(config.task_dir + f + ".csv") for f in files)
+    files_open = tuple(config.task_dir + f + ".csv" for f in files)
 
+    # Metrics of each file, recorded by the workers and completed with the cpa and output stages
+    report = {}
+    metrics.take()
     with open(out2, "w") as error:
-        with Pool() as pool:
+        with Pool(initializer=init_worker, initargs=(config.profile,)) as pool:
             results = pool.imap_unordered(process_data, files_open)
             for r in tqdm(results, desc="Files", total=len(CELLS["file"].unique())):
                 candidates = r[0]
@@ -77,15 +93,32 @@ def compute_task(config, task):
                 with open(output_dir2 + filename + ".csv", "w") as writer:
                     if candidates is not None and not candidates.empty:
                         if task == "cea":
-                            save_cea(writer, candidates, filename)
+                            with Timer("output"):
+                                save_cea(writer, candidates, filename)
                         elif task == "cta":
-                            save_cta(writer, candidates, filename)
+                            with Timer("output"):
+                                save_cta(writer, candidates, filename)
                         elif task == "cpa" and r[2] is not None and not r[2].empty:
-                            df = compute_cpa(candidates, r[2], r[3])
+                            with Timer("cpa"):
+                                df = compute_cpa(candidates, r[2], r[3])
                             if df is not None:
-                                save_cpa(writer, df, filename)
+                                with Timer("output"):
+                                    save_cpa(writer, df, filename)
                     else:
                         error.write(filename + "\n")
+                report[filename] = metrics.merge(r[-1], metrics.take())
+            # Workers that exit instead of being terminated run their finalizers, e.g. close_async
+            pool.close()
+            pool.join()
+    if config.metrics:
+        metrics.write_report(report, config.metrics)
+
+
+def init_worker(profile_interval):
+    # The metrics recorded before the fork belong to the parent
+    metrics.take()
+    if profile_interval > 0:
+        SamplingProfiler(profile_interval).start()
 
 
 def save_cea(writer, candidates, filename):
@@ -97,9 +130,9 @@ def save_cea(writer, candidates, filename):
 def save_cta(writer, candidates, filename):
     candidates = candidates.sort_values(["freq2", "depth"]).groupby("column").last().reset_index()
     for c in candidates.itertuples():
-        if c.type != "nantype":
-            superclasses = settings.GRAPH.get_superclasses(c.type, True)
-            types = c.type
+        if c.type != URIDictionary.NAN:
+            types = settings.URIS.decode(c.type)
+            superclasses = settings.GRAPH.get_superclasses(types, True)
             for p in superclasses:
                 if p != "http://dbpedia.org/ontology/Agent":
                     types += " " + p
@@ -113,13 +146,20 @@ def save_cpa(writer, candidates, filename):
 
 
 def compute_cpa(head, tail, related):
+    tail_rows = defaultdict(list)
+    for tail_row in tail.itertuples():
+        tail_rows[tail_row.row].append((tail_row.column, tail_row.candidate))
+    # Object -> property map of each head candidate, built once per candidate
+    inverse = {}
     matches = []
     for head_row in head.itertuples():
-        for tail_row in tail[tail["row"] == head_row.row].itertuples():
-            if head_row.candidate in related:
-                objects = {x: k for k, v in related[head_row.candidate] for x in v}
-                if tail_row.candidate in objects:
-                    matches.append((head_row.column, tail_row.column, objects[tail_row.candidate]))
+        if head_row.candidate in related and head_row.row in tail_rows:
+            if head_row.candidate not in inverse:
+                inverse[head_row.candidate] = {x: k for k, v in related[head_row.candidate] for x in v}
+            objects = inverse[head_row.candidate]
+            for column, candidate in tail_rows[head_row.row]:
+                if candidate in objects:
+                    matches.append((head_row.column, column, objects[candidate]))
     if matches:
         df = pd.DataFrame(matches, columns=["head_row", "tail_row", "candidate"])
         df["count"] = df.groupby(["head_row", "tail_row"]).transform("count")
@@ -127,42 +167,89 @@ def compute_cpa(head, tail, related):
         return df
 
 
-def process_data(csv_data):
-    print(csv_data.get_file_name())
-    clean_filename = csv_data.get_file_name().replace("_", " ")
-    idx = clean_filename.find("#")
-    clean_filename = clean_filename[:idx]
-    file_objects = []
-    if not clean_filename.isdigit():
-        search = settings.EC.search_phrase(clean_filename, [], index="dbpedia3", result_size=1)
-        if search:
-            file_objects = search[0]["_source"]["objects"]
-    csv_data.data = csv_data.data.applymap(clean_string)
-    with Timer("Total", settings.PACT) as total:
-        with Timer("Match", settings.PACT) as t:
-            categories, types, related = match_column(get_column(csv_data.data, CELLS, csv_data.get_file_name()), "dbpedia3", file_objects)
-        df = get_most_common(
-            pd.DataFrame(categories,
-                         columns=["column", "row", "keyword", "label", "candidate", "category", "cat_idf", "score"]),
-            pd.DataFrame(types, columns=["column", "row", "keyword", "label", "candidate", "type", "type_idf", "score", "depth"]))
+def load_table(filename):
+    """Reads the columns of the table used by the task, and only the rows read by get_column for cta and cpa."""
+    cells = CELLS[CELLS["file"] == filename.split("/")[-1].split(".csv")[0]]
+    columns = set(cells["column"].astype(int))
+    if TASK == "cpa":
+        columns.update(cells["tail_column"].astype(int))
+    return CSVDataSource(filename, columns=columns, nrows=None if TASK == "cea" else 51)
+
+
+def process_data(filename):
+    """
+    :return: the candidates of the file, its name, the tail candidates and related objects for cpa, and the metrics
+    recorded for the file
+    """
+    with Timer("total", settings.PACT):
+        with Timer("load", settings.PACT):
+            csv_data = load_table(filename)
+        print(csv_data.get_file_name())
+        clean_filename = csv_data.get_file_name().replace("_", " ")
+        idx = clean_filename.find("#")
+        clean_filename = clean_filename[:idx]
+        file_objects = []
+        if not clean_filename.isdigit():
+            search = settings.EC.search_phrase(clean_filename, [], index="dbpedia3", result_size=1)
+            if search:
+                file_objects = search[0]["_source"]["objects"]
+        with Timer("clean", settings.PACT):
+            csv_data.data = clean_frame(csv_data.data)
+        with Timer("match", settings.PACT):
+            categories, types, related = match(get_column(csv_data.data, CELLS, csv_data.get_file_name()), "dbpedia3", file_objects)
+        with Timer("scoring", settings.PACT):
+            df = get_most_common(*candidate_frames(categories, types))
+        result = (df, csv_data.get_file_name())
 
         if TASK == "cpa":
-            categories_tail, types_tail, related_tail = match_column(
-                get_column(csv_data.data, CELLS, csv_data.get_file_name(), "tail_column"), "dbpedia2", file_objects)
-            df_tail = get_most_common(
-                pd.DataFrame(categories_tail,
-                             columns=["column", "row", "keyword", "label", "candidate", "category", "cat_idf", "score"]),
-                pd.DataFrame(types_tail,
-                             columns=["column", "row", "keyword", "label", "candidate", "type", "type_idf", "score", "depth"]))
-
-            return df, csv_data.get_file_name(), df_tail, related, related_tail
-    return df, csv_data.get_file_name()
+            with Timer("match", settings.PACT):
+                categories_tail, types_tail, related_tail = match(
+                    get_column(csv_data.data, CELLS, csv_data.get_file_name(), "tail_column"), "dbpedia2", file_objects)
+            with Timer("scoring", settings.PACT):
+                df_tail = get_most_common(*candidate_frames(categories_tail, types_tail))
+
+            result = (df, csv_data.get_file_name(), df_tail, related, related_tail)
+    return result + (metrics.take(),)
+
+
+def match(elements, index_name, file_objects):
+    if settings.MAX_IN_FLIGHT > 0:
+        # Each pool worker keeps its own event loop and client, so connections are reused between files.
+        if settings.LOOP is None:
+            settings.LOOP = asyncio.new_event_loop()
+            asyncio.set_event_loop(settings.LOOP)
+            settings.AEC = settings.EC.async_connection(settings.MAX_IN_FLIGHT)
+            Finalize(settings.AEC, close_async, exitpriority=10)
+        return settings.LOOP.run_until_complete(match_column_async(elements, index_name, file_objects, settings.AEC))
+    return match_column(elements, index_name, file_objects)
+
+
+def close_async():
+    """Closes the client of the worker before its event loop, when the worker exits."""
+    try:
+        settings.LOOP.run_until_complete(settings.AEC.close())
+    finally:
+        settings.LOOP.close()
+        settings.LOOP = None
+        settings.AEC = None
+
+
+def candidate_frames(categories, types):
+    """Categories and types are kept as URIDictionary codes, they are only decoded when the results are saved."""
+    df_cat = pd.DataFrame(categories,
+                          columns=["column", "row", "keyword", "label", "candidate", "category", "cat_idf", "score"])
+    df_type = pd.DataFrame(types,
+                           columns=["column", "row", "keyword", "label", "candidate", "type", "type_idf", "score", "depth"])
+    return df_cat.astype({"category": np.int32}), df_type.astype({"type": np.int32})
 
 
 def get_most_common(df_cat, df_type):
     global TASK
     if not df_type.empty:
-        df_type.drop(df_type[df_type["type"] == "http://dbpedia.org/ontology/Agent"].index, inplace=True)
+        # Without Agent in the dictionary its code would be NAN, which would drop the unknown types instead
+        if "http://dbpedia.org/ontology/Agent" in settings.URIS:
+            df_type.drop(df_type[df_type["type"] == settings.URIS.encode("http://dbpedia.org/ontology/Agent")].index,
+                         inplace=True)
         df_type = depth(df_type, settings.GRAPH.get_diameter(), settings.GRAPH, "type")
     else:
         if TASK == "cta":
@@ -171,8 +258,7 @@ def get_most_common(df_cat, df_type):
         if not df_type.empty:
             df = pd.merge(df_cat, df_type[["row", "column", "candidate", "type", "type_idf", "depth"]], how="left",
                           on=["row", "column", "candidate"])
-            df["category"] = df["category"].fillna("nancategory")
-            df["type"] = df["type"].fillna("nantype")
+            df["type"] = df["type"].fillna(URIDictionary.NAN).astype(np.int32)
         else:
             df = df_cat
     else:
@@ -189,8 +275,9 @@ def get_most_common(df_cat, df_type):
         df = df.sort_values(by="score", ascending=False).drop_duplicates(
             ["row", "column", "candidate", "category"])
 
-    df["sim"] = df.loc[~df.duplicated(subset=["row", "column", "candidate"])].apply(
-        lambda x: get_max_sim(x["keyword"], x["label"]), axis=1)
+    first = ~df.duplicated(subset=["row", "column", "candidate"])
+    df["sim"] = pd.Series(max_similarity(df.loc[first, "keyword"], df.loc[first, "label"]), index=df.index[first],
+                          dtype=float)
     df["sim"] = df.groupby(["row", "column", "candidate"])["sim"].transform(lambda v: v.ffill())
 
     if not df_cat.empty:
@@ -219,17 +306,6 @@ def get_most_common(df_cat, df_type):
     return df
 
 
-def get_max_sim(term, labels):
-    max_sim = 0
-    if term:
-        for l in labels:
-            if l:
-                sim = levenshtein_similarity(term, l)
-                if sim > max_sim:
-                    max_sim = sim
-    return max_sim
-
-
 def count_non_duplicates(df, name, new_column):
     df["count"] = np.where(~df.duplicated(subset=["row", "column", name]), 1, 0)
     df[new_column] = df.groupby([name, "column"])["count"].transform(np.sum)
@@ -239,7 +315,7 @@ def count_non_duplicates(df, name, new_column):
         df[new_column] = ((df[new_column] / df["count_max"]) * 0.7) + (df["cat_idf"] * 0.3)
     else:
         df[new_column] = ((df[new_column] / df["count_max"]) * 0.7) + (df["type_idf"] * 0.15) + ((df["depth"] / settings.GRAPH.get_max_depth()) * 0.15)
-    df.loc[df[name] == "nan" + name, new_column] = 0
+    df.loc[df[name] == URIDictionary.NAN, new_column] = 0
     return df
 
 
@@ -248,15 +324,18 @@ def get_column(data, cells, filename, column="column"):
     columns = cells[cells["file"] == filename][column].astype(int).unique()
     if TASK == "cea":
         rows = cells[cells["file"] == filename]["row"].astype(int)
-        for d in data.loc[np.unique(rows.values), [c for c in columns if c < len(data.columns)]].iterrows():
+        for d in data.loc[np.unique(rows.values), [c for c in columns if c in data.columns]].iterrows():
             yield d
     else:
-        for d in data.loc[1:50, [c for c in columns if c < len(data.columns)]].iterrows():
+        for d in data.loc[1:50, [c for c in columns if c in data.columns]].iterrows():
             yield d
 
 
-def depth(candidates, diameter, arango, column="candidate"):
-    candidates["depth"] = candidates[column].apply(arango.get_depth)
+def depth(candidates, diameter, arango, column="type"):
+    # Types missing from the dictionary, e.g. added by the incremental updates, have no depth
+    depths = {c: arango.get_depth(settings.URIS.decode(c)) if c != URIDictionary.NAN else 0
+              for c in candidates[column].unique()}
+    candidates["depth"] = candidates[column].map(depths)
     return candidates.copy()
 
 
@@ -1,13 +1,16 @@
 import math
+import os
 import time
-from collections import defaultdict
+from collections import defaultdict, Counter
 from multiprocessing.pool import Pool
 
 from arango import ArangoClient, VertexCollectionDeleteError, EdgeDefinitionDeleteError
 from tqdm import tqdm
 
-from utilities import settings
+from classes.DistanceOracle import DistanceOracle
+from classes.SchemaSnapshot import write_snapshot
 from utilities.general import chunks
+from utilities.graph import transitive_closure, diameter, longest_paths
 
 
 class ArangoSchemaGraph:
@@ -33,6 +36,11 @@ class ArangoSchemaGraph:
         self._children = defaultdict(list)
         self._object_properties = defaultdict(list)
         self._depth_types = {}
+        self._ancestors = {}
+        self._ancestor_uris = {}
+        self._descendants = {}
+        self._oracle = None
+        self._hierarchy_oracle = None
 
     def init(self):
         if self.sys_db.has_database(self.name):
@@ -71,6 +79,32 @@ class ArangoSchemaGraph:
             "value": self._calculate_diameter()
         })
 
+    def export_snapshot(self, path):
+        """Saves the classes, hierarchy, depths and properties as a SchemaSnapshot in the directory path."""
+        self._reset()
+        self._properties = {}
+        ontology = self.ontology()
+        _, superclasses = self.hierarchy()
+        print(f"Exporting snapshot to {path}")
+        write_snapshot(path,
+                       {doc["uri"]: [ontology[s]["uri"] for s in superclasses.get(_id, ())]
+                        for _id, doc in ontology.items()},
+                       {doc["uri"]: doc.get("depth", 0) for doc in ontology.values()},
+                       self.properties())
+
+    def _reset(self):
+        """Drops the classes and hierarchy read from the database, so they are read again when needed."""
+        self._ontology = {}
+        self._uri_map = {}
+        self._parents = defaultdict(list)
+        self._children = defaultdict(list)
+        self._depth_types = {}
+        self._ancestors = {}
+        self._ancestor_uris = {}
+        self._descendants = {}
+        self._oracle = None
+        self._hierarchy_oracle = None
+
     def load_ontologies(self, ontologies):
         classes = []
         subclass_edges = []
@@ -172,36 +206,33 @@ class ArangoSchemaGraph:
         else:
             return None
 
-    @staticmethod
-    def get_path(doc_id, d):
-        queue = [doc_id]
-        tree = set()
-        while queue:
-            current = queue.pop()
-            superclass = d[current]
-            if len(superclass) == 1:
-                queue.append(superclass[0])
-                tree.add(superclass[0])
-            elif len(superclass) != 0:
-                print("more than one parent")
-
-        return tree
+    def ancestors(self):
+        """Transitive superclasses of every class, following all the parents of classes with more than one."""
+        if not self._ancestors:
+            _, superclasses = self.hierarchy()
+            self._ancestors = transitive_closure(self.ontology(), superclasses)
+            self._ancestor_uris = {_id: frozenset(self.get_uri_from_document(a) for a in ancestors)
+                                   for _id, ancestors in self._ancestors.items()}
+        return self._ancestors
+
+    def descendants(self):
+        """Transitive subclasses of every class."""
+        if not self._descendants:
+            subclasses, _ = self.hierarchy()
+            self._descendants = transitive_closure(self.ontology(), subclasses)
+        return self._descendants
 
     def get_subclasses(self, doc_id):
-        if not self._parents:
-            self.hierarchy()
-        return self.get_path(doc_id, self._parents)
+        return self.descendants().get(doc_id, frozenset())
 
     def get_superclasses(self, doc_id, return_uri=False):
         if "http://dbpedia.org/ontology/" in doc_id:
             doc_id = self.get_document_from_uri(doc_id)
-        if not self._children:
-            self.hierarchy()
-        parents = self.get_path(doc_id, self._children)
+        self.ancestors()
         if not return_uri:
-            return parents
+            return self._ancestors.get(doc_id, frozenset())
         else:
-            return set(self.get_uri_from_document(parent_id) for parent_id in parents)
+            return self._ancestor_uris.get(doc_id, frozenset())
 
     def get_graph_name(self):
         return self.graph.name
@@ -214,26 +245,11 @@ class ArangoSchemaGraph:
             return self._diameter
 
     def get_tree(self, _id, distance):
-        self.hierarchy()
-        queue = [[_id]]
-        position = 0
-        tree = set()
-        while queue and position <= distance:
-            current = queue.pop()
-            # print(current)
-            this_level = []
-            for each in current:
-                if each in self._parents:
-                    parent = self._parents[each]
-                    this_level.extend(parent)
-                    tree.update(parent)
-                if each in self._children:
-                    child = self._children[each]
-                    this_level.extend(child)
-                    tree.update(child)
-
-            queue.append(this_level)
-            position += 1
+        # Classes reached with up to distance + 1 steps up or down the hierarchy, which include _id after two steps
+        oracle = self.hierarchy_oracle()
+        tree = oracle.neighbourhood(_id, distance + 1)
+        if distance >= 1 and oracle.adjacency.get(_id):
+            tree.add(_id)
         return tree
 
     def get_depths(self, uri):
@@ -281,21 +297,31 @@ class ArangoSchemaGraph:
 
     def calculate_idf(self):
         N = self.properties()["types_count"]
-        classes = self.db.collection("classes")
+        # Document frequency of every type, counted in a single pass over the types collection
+        frequencies = Counter()
+        documents = 0
+        start = time.time()
+        cursor = self.db.aql.execute("FOR doc IN types RETURN doc.type", batch_size=10000, stream=True)
+        for types in tqdm(cursor, total=self.db.collection("types").count(), desc="Types", unit="docs"):
+            documents += 1
+            if isinstance(types, list):
+                frequencies.update(set(types))
+        elapsed = max(time.time() - start, 1e-9)
+        print(f"Counted {len(frequencies)} types in {documents} documents, {elapsed:.1f}s "
+              f"({documents / elapsed:.0f} docs/s)")
+
+        updates = []
         max_idf = 0
-        for c in tqdm(classes.all().batch(), total=classes.count(), desc="Documents"):
+        for c in self.db.collection("classes").all():
             if "typeidf" not in c:
-                cid = c["uri"]
-                query = f"FOR doc IN types FILTER @cid IN doc.type[*] RETURN doc"
-                doc = tuple(x for x in self.db.aql.execute(query, bind_vars={"cid": cid}))
-                idf = math.log(N / (1 + len(doc)))
-                c["typeidf"] = idf
-                classes.update(c)
+                idf = math.log(N / (1 + frequencies[c["uri"]]))
+                updates.append({"_key": c["_key"], "typeidf": idf})
             else:
                 idf = c["typeidf"]
 
             if idf > max_idf:
                 max_idf = idf
+        self.db.collection("classes").import_bulk(updates, on_duplicate="update")
 
         p = self.db.collection("properties")
         if p.has("max_idf"):
@@ -338,17 +364,20 @@ class ArangoSchemaGraph:
         return max_depth
 
     def calculate_max_depth(self):
-        max_depth = 0
-        classes = self.db.collection("classes")
-        for c in tqdm(classes.all().batch(), total=classes.count(), desc="Documents"):
-            _id = c["_id"]
-            depth = len(self.get_superclasses(c["_id"]))
-            c["depth"] = depth
-            classes.update(c)
-
-            if depth > max_depth:
-                max_depth = depth
-        return max_depth
+        """
+        Sets the depth of every class to the number of superclass edges on its longest path to a root, which is the
+        number of ancestors when every class has a single parent.
+        """
+        self._reset()
+        _, superclasses = self.hierarchy()
+        depths = longest_paths(self.ontology(), superclasses)
+        updates = []
+        for _id, doc in self.ontology().items():
+            doc["depth"] = depths[_id]
+            updates.append({"_key": doc["_key"], "depth": doc["depth"]})
+        print(f"Updating the depth of {len(updates)} classes")
+        self.db.collection("classes").import_bulk(updates, on_duplicate="update")
+        return max((u["depth"] for u in updates), default=0)
 
     def get_depth(self, doc_id):
         if "classes" not in doc_id:
@@ -362,17 +391,25 @@ class ArangoSchemaGraph:
     def get_max_idf(self):
         return self.properties()["max_idf"]
 
+    def oracle(self):
+        """Distances between classes over the subclassof, objectproperties and classmappings edges."""
+        if self._oracle is None:
+            self._oracle = DistanceOracle(self.adjacency())
+            if self.config.distances and os.path.exists(self.config.distances):
+                self._oracle.load_table(self.config.distances)
+        return self._oracle
+
+    def hierarchy_oracle(self):
+        """Distances between classes over the subclassof edges."""
+        if self._hierarchy_oracle is None:
+            self._hierarchy_oracle = DistanceOracle(self.adjacency(("subclassof",)))
+        return self._hierarchy_oracle
+
     def shortest_path_length(self, nodes):
         combination = tuple(sorted(nodes))
-        if combination not in settings.DISTANCES:
-            cursor = self.db.aql.execute(
-                f"FOR v IN ANY SHORTEST_PATH @source TO @target objectproperties,classmappings,subclassof RETURN v",
-                bind_vars={"source": nodes[0], "target": nodes[1]})
-            length = len([x for x in cursor])
-            settings.DISTANCES[combination] = length
-            return combination, length
-        else:
-            return combination, settings.DISTANCES[combination]
+        distance = self.oracle().distance(nodes[0], nodes[1])
+        # Number of vertices in the path, 0 if there's no path
+        return combination, distance + 1 if distance >= 0 else 0
 
     def shortest_path(self, nodes):
         pregel = self.db.pregel
@@ -453,8 +490,15 @@ class ArangoSchemaGraph:
 
         # TODO: deal with datatype and object properties mappings
 
+    def adjacency(self, collections=("subclassof", "objectproperties", "classmappings")):
+        """Neighbours of every class over the edges of the given collections, ignoring their direction."""
+        adjacency = {_id: set() for _id in self.ontology()}
+        for name in collections:
+            for e in self.db.collection(name).all():
+                adjacency.setdefault(e["_from"], set()).add(e["_to"])
+                adjacency.setdefault(e["_to"], set()).add(e["_from"])
+        return adjacency
+
     def _calculate_diameter(self):
-        query = f"FOR s IN classes FOR t IN classes FILTER s._id < t._id LET p = SUM((FOR v, e IN ANY " \
-            f"SHORTEST_PATH s TO t GRAPH @graphName RETURN 1)) - 1 SORT p DESC LIMIT 1 RETURN p"
         print("Calculating diameter...")
-        return [x for x in self.db.aql.execute(query, bind_vars={"graphName": self.get_graph_name()})][0]
+        return diameter(self.adjacency())
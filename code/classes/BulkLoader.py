@@ -0,0 +1,130 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from elasticsearch import ConnectionError, TransportError
+from elasticsearch.helpers import expand_action
+from tqdm import tqdm
+
+
+class BulkLoader:
+    """
+    Sends bulk requests of at most max_chunk_bytes to an index with an adaptive number of concurrent requests. It
+    grows by one after every request the cluster accepts and halves when documents are rejected (429), which are
+    sent again after an exponential backoff.
+    """
+    def __init__(self, es, index_name, max_chunk_bytes=10 * 2 ** 20, max_chunk_docs=5000, initial_threads=4,
+                 min_threads=1, max_threads=16, max_retries=8, initial_backoff=1, max_backoff=60,
+                 request_timeout=120):
+        self.es = es
+        self.index_name = index_name
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_chunk_docs = max_chunk_docs
+        self.concurrency = initial_threads
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.docs = 0
+        self.bytes = 0
+        self.failed = 0
+        self.retries = 0
+
+    def chunks(self, actions):
+        """Yields lists with the serialized lines of each action, of at most max_chunk_bytes or max_chunk_docs."""
+        serializer = self.es.transport.serializer
+        chunk = []
+        size = 0
+        for action in actions:
+            action, data = expand_action(action)
+            lines = (serializer.dumps(action),) + ((serializer.dumps(data),) if data is not None else ())
+            lines_size = sum(len(l.encode("utf8")) + 1 for l in lines)
+            if chunk and (size + lines_size > self.max_chunk_bytes or len(chunk) >= self.max_chunk_docs):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(lines)
+            size += lines_size
+        if chunk:
+            yield chunk
+
+    def load(self, actions):
+        """
+        :param actions: iterable of documents or bulk actions, it is read as the requests are sent
+        :return: dictionary with the number of documents indexed and failed, retries, seconds and megabytes sent
+        """
+        start = time.time()
+        chunks = self.chunks(actions)
+        exhausted = False
+        pending = set()
+        with ThreadPoolExecutor(self.max_threads) as executor, tqdm(unit=" docs", desc="Indexing") as progress:
+            while pending or not exhausted:
+                while not exhausted and len(pending) < self.concurrency:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                    else:
+                        pending.add(executor.submit(self._send, chunk, 0))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    indexed, size, rejected, failed, attempt = future.result()
+                    self.docs += indexed
+                    self.failed += failed
+                    self.bytes += size
+                    progress.update(indexed)
+                    if not rejected:
+                        self.concurrency = min(self.max_threads, self.concurrency + 1)
+                        continue
+                    self.concurrency = max(self.min_threads, self.concurrency // 2)
+                    if attempt < self.max_retries:
+                        self.retries += 1
+                        pending.add(executor.submit(self._send, rejected, attempt + 1))
+                    else:
+                        print(f"Failed to load {len(rejected)} documents after {attempt} retries")
+                        self.failed += len(rejected)
+                progress.set_postfix(threads=self.concurrency, MB=f"{self.bytes / 2 ** 20:.0f}")
+
+        seconds = max(time.time() - start, 1e-6)
+        megabytes = self.bytes / 2 ** 20
+        print(f"Indexed {self.docs} documents in {seconds:.0f}s: {self.docs / seconds:.0f} docs/s, "
+              f"{megabytes / seconds:.1f} MB/s, {self.retries} retries, {self.failed} failed")
+        return {"docs": self.docs, "failed": self.failed, "retries": self.retries, "seconds": seconds,
+                "megabytes": megabytes}
+
+    def _send(self, chunk, attempt):
+        """
+        Sends a chunk after the backoff of its attempt.
+        :return: number of documents indexed, bytes indexed, the lines of the rejected documents, number of documents
+        that failed and the attempt
+        """
+        if attempt:
+            time.sleep(min(self.initial_backoff * 2 ** (attempt - 1), self.max_backoff))
+        body = "".join(l + "\n" for lines in chunk for l in lines)
+        try:
+            response = self.es.bulk(body=body, index=self.index_name, request_timeout=self.request_timeout)
+        except ConnectionError:
+            return 0, 0, chunk, 0, attempt
+        except TransportError as e:
+            if e.status_code == 429:
+                return 0, 0, chunk, 0, attempt
+            raise
+
+        indexed = 0
+        size = 0
+        rejected = []
+        failed = 0
+        for lines, item in zip(chunk, response["items"]):
+            result = next(iter(item.values()))
+            status = result.get("status", 200)
+            if status == 429:
+                rejected.append(lines)
+            elif status >= 300:
+                failed += 1
+                print(f'Failed to load document {result.get("_id")}: {result.get("error")}')
+            else:
+                indexed += 1
+                size += sum(len(l.encode("utf8")) + 1 for l in lines)
+        return indexed, size, rejected, failed, attempt
@@ -1,12 +1,22 @@
+from csv import reader
+from itertools import islice
+
 from pandas import read_csv, np
 from pandas.errors import ParserError
 
 
 class CSVDataSource:
-    def __init__(self, filename, sep=","):
+    def __init__(self, filename, sep=",", columns=None, nrows=None):
+        """
+        :param columns: positions of the columns to read, None to read all of them. The columns keep their
+        position in the file as label.
+        :param nrows: number of rows to read from the start of the file, None to read all of them
+        """
         super().__init__()
         self.filename = filename
         self.separator = sep
+        self.columns = set(columns) if columns is not None else None
+        self.nrows = nrows
         self.data = self._read()
 
     def get_instances(self):
@@ -27,14 +37,34 @@ class CSVDataSource:
     def number_columns(self):
         return len(self.data.columns)
 
+    def _widths(self, rows=100):
+        """Returns the number of fields of each of the first rows."""
+        with open(self.filename, newline="") as f:
+            lines = reader(f, delimiter=self.separator, quotechar='"', escapechar='\\', skipinitialspace=True)
+            return [len(l) for l in islice(lines, rows)]
+
     def _read(self):
+        usecols = None
+        short_header = False
+        if self.columns is not None:
+            # Positions beyond the widest row are ignored, read_csv can't select columns by name without a header
+            widths = self._widths()
+            width = max(widths, default=0)
+            usecols = sorted(c for c in self.columns if c < width)
+            # With usecols, read_csv drops the fields beyond the header instead of raising a ParserError
+            short_header = bool(widths) and widths[0] < width
         try:
-            return read_csv(self.filename, sep=self.separator, header=None,
-                             quotechar='"', skipinitialspace=True, escapechar='\\', dtype=str)
+            if short_header:
+                raise ParserError("The header has fewer fields than the rows")
+            return read_csv(self.filename, sep=self.separator, header=None, usecols=usecols, nrows=self.nrows,
+                            quotechar='"', skipinitialspace=True, escapechar='\\', dtype=str)
         except ParserError:
-            csv = read_csv(self.filename, sep=self.separator, header=None,
-                            skiprows=1, quotechar='"', skipinitialspace=True, escapechar='\\')
+            nrows = self.nrows - 1 if self.nrows is not None else None
+            csv = read_csv(self.filename, sep=self.separator, header=None, usecols=usecols, nrows=nrows,
+                           skiprows=1, quotechar='"', skipinitialspace=True, escapechar='\\')
             # print(list(range(len(csv.columns))))
+            if csv.columns.empty:
+                return csv
             csv.loc[-1] = list(np.nan for _ in range(len(csv.columns)))
             csv.index = csv.index + 1
             csv.sort_index(inplace=True)
@@ -0,0 +1,105 @@
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+from utilities.graph import bfs
+
+
+class DistanceOracle:
+    """
+    Shortest path lengths, in number of edges, between the nodes of an undirected graph, computed locally with BFS.
+    Point queries are kept in a bounded LRU, and the distances between a set of nodes can be precomputed into a table
+    that is saved to disk and memory-mapped when loaded.
+    """
+    def __init__(self, adjacency, cache_size=100000):
+        """
+        :param adjacency: dictionary with the set of neighbours of every node, in both directions
+        """
+        self.adjacency = adjacency
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._table = None
+        self._table_ids = {}
+
+    def distance(self, source, target):
+        """Returns the length of the shortest path between source and target, -1 if they aren't connected."""
+        if source == target:
+            return 0
+        if source in self._table_ids and target in self._table_ids:
+            return int(self._table[self._table_ids[source], self._table_ids[target]])
+        key = (source, target) if source <= target else (target, source)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        d = self._bidirectional_bfs(source, target)
+        self._cache[key] = d
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return d
+
+    def distances(self, source, targets):
+        """Returns the distances between source and each one of the targets with a single BFS, -1 if not connected."""
+        reached = bfs(self.adjacency, source)
+        return np.array([reached.get(t, -1) for t in targets], dtype=np.int32)
+
+    def neighbourhood(self, node, radius):
+        """Returns the nodes at a distance between 1 and radius from node."""
+        reached = {node}
+        frontier = [node]
+        for _ in range(radius):
+            next_frontier = []
+            for current in frontier:
+                for n in self.adjacency.get(current, ()):
+                    if n not in reached:
+                        reached.add(n)
+                        next_frontier.append(n)
+            frontier = next_frontier
+        reached.discard(node)
+        return reached
+
+    def precompute(self, nodes, path):
+        """Saves the distances between every pair of nodes in the directory path."""
+        nodes = list(nodes)
+        table = np.full((len(nodes), len(nodes)), -1, dtype=np.int16)
+        for i, source in enumerate(tqdm(nodes, desc="Distances")):
+            table[i] = self.distances(source, nodes)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "distances.npy"), table)
+        with open(os.path.join(path, "nodes.json"), "w") as f:
+            json.dump(nodes, f)
+
+    def load_table(self, path):
+        with open(os.path.join(path, "nodes.json")) as f:
+            self._table_ids = {n: i for i, n in enumerate(json.load(f))}
+        self._table = np.load(os.path.join(path, "distances.npy"), mmap_mode="r")
+
+    def _bidirectional_bfs(self, source, target):
+        if source not in self.adjacency or target not in self.adjacency:
+            return -1
+        distances = ({source: 0}, {target: 0})
+        frontiers = ([source], [target])
+        while frontiers[0] and frontiers[1]:
+            # Expand the smallest frontier
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other = distances[side], distances[1 - side]
+            next_frontier = []
+            best = -1
+            for current in frontiers[side]:
+                for n in self.adjacency.get(current, ()):
+                    if n in other:
+                        length = seen[current] + 1 + other[n]
+                        if best < 0 or length < best:
+                            best = length
+                    if n not in seen:
+                        seen[n] = seen[current] + 1
+                        next_frontier.append(n)
+            if best >= 0:
+                return best
+            if side == 0:
+                frontiers = (next_frontier, frontiers[1])
+            else:
+                frontiers = (frontiers[0], next_frontier)
+        return -1
@@ -1,6 +1,15 @@
-from elasticsearch import Elasticsearch
+import asyncio
+import json
+
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 from elasticsearch.helpers import parallel_bulk, scan
 
+from classes.BulkLoader import BulkLoader
+from classes.QueryCache import QueryCache
+from utilities import metrics
+from utilities.general import chunks
+from utilities.metrics import Timer
+
 
 def normalise_score(results):
     new_results = []
@@ -17,16 +26,92 @@ def normalise_score(results):
     return new_results
 
 
+def query_fingerprint(query_type, query):
+    """Splits the arguments of a search into the (keywords, context, filters) used by the cache keys."""
+    if query_type == "combined2":
+        return query[0], (), query[1:]
+    return query[0], query[1], ()
+
+
+def combined_body(keywords, related):
+    return {
+        "min_score": 1.0,
+        "sort": ["_score"],
+        "query": {
+            "dis_max": {
+                "queries": [
+                    {"term": {"labels.keyword": {"value": keywords, "boost": 5}}},
+                    {"match": {"labels": keywords}},
+                    {"terms": {"uri.keyword": related}},
+                ],
+                "tie_breaker": 0.2
+            }
+        }
+    }
+
+
+def combined2_body(keywords, categories, types):
+    return {
+        "min_score": 1.0,
+        "sort": ["_score"],
+        "query": {
+            "bool": {
+                "must": [
+                    {"match": {"labels": keywords}},
+                    {"terms": {"types.keyword": types}},
+                ],
+                "should": {"terms": {"category.keyword": categories}}
+            }
+        }
+    }
+
+
 class ElasticConnection:
     def __init__(self, host, port):
+        self.host = host
+        self.port = port
         self.es = Elasticsearch([{"host": host, "port": port}])
         self.total = 0
+        self.cache = None
+
+    def async_connection(self, max_in_flight):
+        return AsyncElasticConnection(self.host, self.port, max_in_flight, self)
+
+    def enable_cache(self, filename, memory_size=10000, disk_size=1000000):
+        self.cache = QueryCache(filename, memory_size, disk_size)
+
+    def index_version(self, index):
+        """Identifies the current contents of an index, it changes when the index is rebuilt or its _meta is updated."""
+        index_settings = next(iter(self.es.indices.get_settings(index=index).values()))
+        mappings = next(iter(self.es.indices.get_mapping(index=index).values()))["mappings"]
+        return index_settings["settings"]["index"]["uuid"] + json.dumps(mappings.get("_meta", {}), sort_keys=True)
 
-    def add_index(self, index_name, collection, body, overwrite=False):
+    def cache_key(self, query_type, query, index, size):
+        if index not in self.cache.versions:
+            self.cache.set_version(index, self.index_version(index))
+        return QueryCache.key(query_type, *query_fingerprint(query_type, query), index, size)
+
+    def _cached(self, query_type, query, index, size, search):
+        if self.cache is None:
+            with Timer("es." + query_type, histogram=True):
+                return search()
+        key = self.cache_key(query_type, query, index, size)
+        results = self.cache.get(key)
+        if results is None:
+            with Timer("es." + query_type, histogram=True):
+                results = search()
+            self.cache.put(key, index, results)
+        return results
+
+    def add_index(self, index_name, collection, body, overwrite=False, chunk_size=500, queue_size=4, adaptive=False):
         """
         :param index_name: name of existing of new index to add
-        :param collection: list of documents in dictionary format, e.g. [{field1: value1} {field1: value2}]
+        :param collection: iterable of documents in dictionary format, e.g. [{field1: value1} {field1: value2}].
+        It is consumed as the documents are sent, so a generator keeps only the pending chunks in memory.
         :param overwrite: True to overwrite an existing index with index_name, False to append to index_name
+        :param chunk_size: number of documents sent in each bulk request
+        :param queue_size: number of chunks waiting for a free bulk thread before the collection stops being read
+        :param adaptive: True to load the documents with bulk_load
         :return:
         """
         self.es.indices.put_template(name="default", body={
@@ -43,22 +128,87 @@ class ElasticConnection:
         if overwrite and self.es.indices.exists(index=index_name):
             self.es.indices.delete(index=index_name)
             self.es.indices.create(index_name, body=body)
+        if adaptive:
+            self.bulk_load(index_name, collection)
+            return
         for ok, result in parallel_bulk(self.es,
                                         collection,
                                         thread_count=7,
                                         index=index_name,
                                         request_timeout=30,
-                                        chunk_size=500
+                                        chunk_size=chunk_size,
+                                        queue_size=queue_size
                                         ):
             if not ok:
                 print(f'Failed to load document {result.popitem()["_id"]}')
 
+    def bulk_load(self, index_name, collection, force_merge=True, **options):
+        """
+        Loads the documents with a BulkLoader. A missing index is created with the dynamic mappings, like the index
+        created by the first bulk request of add_index, so the .keyword subfields used by the searches exist.
+        Refreshes and replicas are disabled during the load and restored afterwards, then the index is force-merged.
+        :param options: arguments of the BulkLoader, e.g. max_chunk_bytes or max_threads
+        :return: statistics of the load
+        """
+        if not self.es.indices.exists(index=index_name):
+            self.es.indices.create(index_name)
+        index_settings = next(iter(self.es.indices.get_settings(index=index_name).values()))["settings"]["index"]
+        previous = {"refresh_interval": index_settings.get("refresh_interval"),
+                    "number_of_replicas": index_settings.get("number_of_replicas")}
+        self.es.indices.put_settings(index=index_name, body={"index": {"refresh_interval": "-1",
+                                                                       "number_of_replicas": 0}})
+        try:
+            stats = BulkLoader(self.es, index_name, **options).load(collection)
+        finally:
+            # None resets a setting that wasn't set to its default
+            self.es.indices.put_settings(index=index_name, body={"index": previous})
+        self.es.indices.refresh(index=index_name)
+        if force_merge:
+            self.es.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=3600)
+        return stats
+
     def delete_index(self, index_name):
         self.es.indices.delete(index_name)
 
     def index_exists(self, index_name):
         return self.es.indices.exists([index_name])
 
+    def has_keyword(self, index_name, field):
+        """True if field has the .keyword subfield of the dynamic mappings, used by the exact searches."""
+        mappings = next(iter(self.es.indices.get_mapping(index=index_name).values()))["mappings"]
+        subfields = mappings.get("properties", {}).get(field, {}).get("fields", {})
+        return subfields.get("keyword", {}).get("type") == "keyword"
+
+    def find_uris(self, index_name, uris):
+        """Returns the hit of the document of each uri found in the index."""
+        response = self.es.search(index=index_name, body={"query": {"terms": {"uri.keyword": list(uris)}}},
+                                  size=len(uris))
+        return {hit["_source"]["uri"]: hit for hit in response["hits"]["hits"]}
+
+    def bulk(self, index_name, actions, chunk_size=500):
+        """
+        :param actions: iterable of bulk actions, e.g. {"_op_type": "update", "_id": id, "doc": {field: value}}
+        :return: number of actions applied
+        """
+        applied = 0
+        for ok, result in parallel_bulk(self.es,
+                                        actions,
+                                        thread_count=7,
+                                        index=index_name,
+                                        request_timeout=30,
+                                        chunk_size=chunk_size,
+                                        raise_on_error=False
+                                        ):
+            if ok:
+                applied += 1
+            else:
+                print(f'Failed to apply action {result}')
+        return applied
+
+    def set_meta(self, index_name, meta):
+        """Replaces the _meta of the index mapping, which changes the index_version of the index."""
+        self.es.indices.put_mapping(index=index_name, body={"_meta": meta})
+
     def search_phrase(self, keywords, related, index="", result_size=10):
         body = {
             "min_score": 1.0,
@@ -80,43 +230,103 @@ class ElasticConnection:
                         }]
 
                 }}}
-        return self.es.search(index=index, body=body, allow_partial_search_results=True, size=result_size
-                              )["hits"]["hits"]
+        return self._cached("phrase", (keywords, related), index, result_size,
+                            lambda: self.es.search(index=index, body=body, allow_partial_search_results=True,
+                                                   size=result_size)["hits"]["hits"])
 
     def search_combined(self, keywords, related, index, size):
-        body = {
-            "min_score": 1.0,
-            "sort": ["_score"],
-            "query": {
-                "dis_max": {
-                    "queries": [
-                        {"term": {"labels.keyword": {"value": keywords, "boost": 5}}},
-                        {"match": {"labels": keywords}},
-                        {"terms": {"uri.keyword": related}},
-                    ],
-                    "tie_breaker": 0.2
-                }
-            }
-        }
-        return normalise_score(self.es.search(index=index, body=body, size=size)["hits"]["hits"])
+        return self._cached("combined", (keywords, related), index, size,
+                            lambda: normalise_score(self.es.search(index=index, body=combined_body(keywords, related),
+                                                                   size=size)["hits"]["hits"]))
 
     def search_combined2(self, keywords, categories, types, index, size):
-        body = {
-            "min_score": 1.0,
-            "sort": ["_score"],
-            "query": {
-                "bool": {
-                    "must": [
-                        {"match": {"labels": keywords}},
-                        {"terms": {"types.keyword": types}},
-                    ],
-                    "should": {"terms": {"category.keyword": categories}}
-                }
-            }
-        }
-        return normalise_score(self.es.search(index=index, body=body, size=size)["hits"]["hits"])
+        return self._cached("combined2", (keywords, categories, types), index, size,
+                            lambda: normalise_score(self.es.search(index=index,
+                                                                   body=combined2_body(keywords, categories, types),
+                                                                   size=size)["hits"]["hits"]))
+
+    def search_combined_many(self, queries, index, size, batch_size=0):
+        """
+        :param queries: sequence of (keywords, related) tuples
+        :param batch_size: number of queries per _msearch request, 0 or 1 sends one search per query
+        :return: list with the normalised results of each query, in the same order as queries
+        """
+        if batch_size <= 1:
+            return [self.search_combined(k, r, index=index, size=size) for k, r in queries]
+        return self._msearch("combined", queries, combined_body, index, size, batch_size)
+
+    def search_combined2_many(self, queries, index, size, batch_size=0):
+        """
+        :param queries: sequence of (keywords, categories, types) tuples
+        :param batch_size: number of queries per _msearch request, 0 or 1 sends one search per query
+        :return: list with the normalised results of each query, in the same order as queries
+        """
+        if batch_size <= 1:
+            return [self.search_combined2(k, c, t, index=index, size=size) for k, c, t in queries]
+        return self._msearch("combined2", queries, combined2_body, index, size, batch_size)
 
+    def _msearch(self, query_type, queries, body, index, size, batch_size):
+        results = [None] * len(queries)
+        keys = [None] * len(queries)
+        if self.cache is not None:
+            for i, query in enumerate(queries):
+                keys[i] = self.cache_key(query_type, query, index, size)
+                results[i] = self.cache.get(keys[i])
+        missing = [i for i, r in enumerate(results) if r is None]
+        for batch in chunks(missing, batch_size):
+            request = []
+            for i in batch:
+                request.append({"index": index})
+                request.append(dict(body(*queries[i]), size=size))
+            metrics.count(f"es.msearch_{query_type}_queries", len(batch))
+            with Timer(f"es.msearch_{query_type}", histogram=True):
+                responses = self.es.msearch(body=request)["responses"]
+            for i, response in zip(batch, responses):
+                if "error" in response:
+                    print(f'Failed search in {index}: {response["error"]}')
+                    results[i] = []
+                else:
+                    results[i] = normalise_score(response["hits"]["hits"])
+                    if self.cache is not None:
+                        self.cache.put(keys[i], index, results[i])
+        return results
 
     def total_number_docs(self, index_name):
         res = self.es.indices.stats(index_name)
         return int(res["_all"]["primaries"]["docs"]["count"])
+
+
+class AsyncElasticConnection:
+    """
+    Asyncio counterpart of the ElasticConnection searches used by match_column_async. At most max_in_flight
+    requests are sent at the same time, the others wait for a free slot. Results are shared with the cache of the
+    blocking connection, if it has one.
+    """
+    def __init__(self, host, port, max_in_flight, connection=None):
+        self.es = AsyncElasticsearch([{"host": host, "port": port}])
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.connection = connection
+
+    async def search_combined(self, keywords, related, index, size):
+        return await self._cached("combined", (keywords, related), index, size, combined_body)
+
+    async def search_combined2(self, keywords, categories, types, index, size):
+        return await self._cached("combined2", (keywords, categories, types), index, size, combined2_body)
+
+    async def _cached(self, query_type, query, index, size, body):
+        cache = self.connection.cache if self.connection is not None else None
+        if cache is not None:
+            key = self.connection.cache_key(query_type, query, index, size)
+            results = cache.get(key)
+            if results is not None:
+                return results
+        async with self.in_flight:
+            with Timer("es." + query_type, histogram=True):
+                response = await self.es.search(index=index, body=body(*query), size=size)
+        results = normalise_score(response["hits"]["hits"])
+        if cache is not None:
+            cache.put(key, index, results)
+        return results
+
+    async def close(self):
+        await self.es.close()
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from utilities import metrics
+
+
+class QueryCache:
+    """
+    Two tier cache for search results. The most recent results are kept in an in-process LRU and every result is
+    also written to a SQLite file, which is shared by all the pool workers and kept between runs. Entries are stored
+    per index and are dropped when the version of that index changes. Hits and misses are counted in the metrics of
+    the process.
+    """
+    def __init__(self, filename, memory_size=10000, disk_size=1000000):
+        self.filename = filename
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.versions = {}
+        self._memory = OrderedDict()
+        self._db = None
+        self._pid = None
+        self._inserts = 0
+        # Access times of the disk hits, written in batches
+        self._accessed = {}
+
+    @staticmethod
+    def key(query_type, keywords, context, filters, index, size):
+        """
+        :param context: uris used to boost the results, the order is not relevant
+        :param filters: sequences of categories or types, the order inside each one is not relevant
+        """
+        fingerprint = json.dumps([query_type, keywords, sorted(set(context)), [sorted(set(f)) for f in filters],
+                                  index, size], ensure_ascii=False)
+        return hashlib.sha1(fingerprint.encode("utf8")).hexdigest()
+
+    def set_version(self, index, version):
+        db = self._connection()
+        row = db.execute("SELECT version FROM versions WHERE idx = ?", (index,)).fetchone()
+        if row is None or row[0] != version:
+            db.execute("DELETE FROM entries WHERE idx = ?", (index,))
+            db.execute("INSERT OR REPLACE INTO versions VALUES (?, ?)", (index, version))
+            for key in [k for k, v in self._memory.items() if v[0] == index]:
+                del self._memory[key]
+        self.versions[index] = version
+
+    def get(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            metrics.count("es.cache_hits")
+            return self._memory[key][1]
+        db = self._connection()
+        row = db.execute("SELECT idx, value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            metrics.count("es.cache_misses")
+            return None
+        metrics.count("es.cache_hits")
+        metrics.count("es.cache_disk_hits")
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= 1000:
+            self._flush_accessed()
+        value = json.loads(row[1])
+        self._remember(key, row[0], value)
+        return value
+
+    def put(self, key, index, value):
+        self._remember(key, index, value)
+        db = self._connection()
+        db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                   (key, index, json.dumps(value, ensure_ascii=False), time.time()))
+        self._inserts += 1
+        if self._inserts % 1000 == 0:
+            self._evict()
+
+    def _remember(self, key, index, value):
+        self._memory[key] = (index, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _flush_accessed(self):
+        if not self._accessed:
+            return
+        db = self._connection()
+        db.execute("BEGIN")
+        db.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(t, k) for k, t in self._accessed.items()])
+        db.execute("COMMIT")
+        self._accessed = {}
+
+    def _evict(self):
+        self._flush_accessed()
+        db = self._connection()
+        extra = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.disk_size
+        if extra > 0:
+            db.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed LIMIT ?)",
+                       (extra,))
+
+    def _connection(self):
+        # SQLite connections can't be shared with forked processes, so each worker opens its own.
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries "
+                             "(key TEXT PRIMARY KEY, idx TEXT, value TEXT, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_idx ON entries (idx)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS versions (idx TEXT PRIMARY KEY, version TEXT)")
+            self._pid = os.getpid()
+        return self._db
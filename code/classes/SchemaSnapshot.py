@@ -0,0 +1,183 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from utilities.graph import transitive_closure
+
+
+def write_snapshot(path, superclasses, depths, properties):
+    """
+    :param path: directory where the arrays are saved
+    :param superclasses: dictionary with the uri of every class and the list of uris of its direct superclasses
+    :param depths: dictionary with the depth of each class uri
+    :param properties: values of the properties collection, e.g. max_depth and diameter
+    """
+    uris = sorted(u.encode("utf8") for u in superclasses)
+    ids = {u.decode("utf8"): i for i, u in enumerate(uris)}
+    parents = [[] for _ in uris]
+    children = [[] for _ in uris]
+    for uri, supers in superclasses.items():
+        for s in supers:
+            if s in ids:
+                parents[ids[uri]].append(ids[s])
+                children[ids[s]].append(ids[uri])
+
+    nodes = range(len(uris))
+    ancestors = transitive_closure(nodes, dict(enumerate(parents)))
+    descendants = transitive_closure(nodes, dict(enumerate(children)))
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "uris.npy"), np.array(uris, dtype=bytes))
+    for name, lists in (("parent", parents), ("child", children),
+                        ("ancestor", [ancestors[i] for i in nodes]), ("descendant", [descendants[i] for i in nodes])):
+        indptr, indices = _csr(lists)
+        np.save(os.path.join(path, name + "_indptr.npy"), indptr)
+        np.save(os.path.join(path, name + "_indices.npy"), indices)
+    np.save(os.path.join(path, "depth.npy"),
+            np.array([depths.get(u.decode("utf8"), 0) for u in uris], dtype=np.int32))
+    with open(os.path.join(path, "properties.json"), "w") as f:
+        json.dump(properties, f)
+
+
+def _csr(lists):
+    indptr = np.zeros(len(lists) + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum([len(l) for l in lists])
+    indices = np.array([i for l in lists for i in sorted(l)], dtype=np.int32)
+    return indptr, indices
+
+
+class SchemaSnapshot:
+    """
+    Read-only copy of the ontology graph exported by ArangoSchemaGraph.export_snapshot. Classes are identified by
+    their position in the sorted uri table. The parents (superclasses) and children (subclasses) of each class, and
+    their transitive closures, are stored as CSR arrays. All the arrays are memory-mapped, so forked pool workers
+    share the same pages.
+    It implements the part of the ArangoSchemaGraph interface used to annotate the tables.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.uri_table = self._load("uris")
+        self.parent_indptr = self._load("parent_indptr")
+        self.parent_indices = self._load("parent_indices")
+        self.child_indptr = self._load("child_indptr")
+        self.child_indices = self._load("child_indices")
+        self.ancestor_indptr = self._load("ancestor_indptr")
+        self.ancestor_indices = self._load("ancestor_indices")
+        self.descendant_indptr = self._load("descendant_indptr")
+        self.descendant_indices = self._load("descendant_indices")
+        self.depth = self._load("depth")
+        self._ancestor_uris = {}
+        with open(os.path.join(path, "properties.json")) as f:
+            self._properties = json.load(f)
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.uri_table)
+
+    def get_document_from_uri(self, uri):
+        key = uri.encode("utf8")
+        if len(key) > self.uri_table.dtype.itemsize:
+            return None
+        i = int(np.searchsorted(self.uri_table, key))
+        if i < len(self.uri_table) and self.uri_table[i] == key:
+            return i
+        return None
+
+    def get_uri_from_document(self, class_id):
+        return self.uri_table[class_id].decode("utf8")
+
+    def parents(self, class_id):
+        return self.parent_indices[self.parent_indptr[class_id]:self.parent_indptr[class_id + 1]]
+
+    def children(self, class_id):
+        return self.child_indices[self.child_indptr[class_id]:self.child_indptr[class_id + 1]]
+
+    def ancestors(self, class_id):
+        return self.ancestor_indices[self.ancestor_indptr[class_id]:self.ancestor_indptr[class_id + 1]]
+
+    def descendants(self, class_id):
+        return self.descendant_indices[self.descendant_indptr[class_id]:self.descendant_indptr[class_id + 1]]
+
+    def get_subclasses(self, class_id):
+        return frozenset(int(i) for i in self.descendants(class_id))
+
+    def get_superclasses(self, class_id, return_uri=False):
+        if isinstance(class_id, str):
+            class_id = self.get_document_from_uri(class_id)
+        if class_id is None:
+            return frozenset()
+        if not return_uri:
+            return frozenset(int(i) for i in self.ancestors(class_id))
+        if class_id not in self._ancestor_uris:
+            self._ancestor_uris[class_id] = frozenset(self.get_uri_from_document(i) for i in self.ancestors(class_id))
+        return self._ancestor_uris[class_id]
+
+    def get_depth(self, uri):
+        class_id = self.get_document_from_uri(uri)
+        if class_id is not None:
+            return int(self.depth[class_id])
+
+    def get_depths(self, uri):
+        return self.get_depth(uri)
+
+    def depths(self):
+        return _Depths(self)
+
+    def uris(self):
+        return _Uris(self)
+
+    def hierarchy(self):
+        return _Adjacency(self, self.children), _Adjacency(self, self.parents)
+
+    def properties(self):
+        return self._properties
+
+    def get_diameter(self):
+        return self._properties["diameter"]
+
+    def get_max_depth(self):
+        return self._properties["max_depth"]
+
+    def get_max_idf(self):
+        return self._properties["max_idf"]
+
+
+class _Uris(Mapping):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, uri):
+        class_id = self.snapshot.get_document_from_uri(uri)
+        if class_id is None:
+            raise KeyError(uri)
+        return class_id
+
+    def __iter__(self):
+        return (u.decode("utf8") for u in self.snapshot.uri_table)
+
+    def __len__(self):
+        return len(self.snapshot)
+
+
+class _Depths(_Uris):
+    def __getitem__(self, uri):
+        return int(self.snapshot.depth[super().__getitem__(uri)])
+
+
+class _Adjacency(Mapping):
+    def __init__(self, snapshot, neighbours):
+        self.snapshot = snapshot
+        self.neighbours = neighbours
+
+    def __getitem__(self, class_id):
+        return [int(i) for i in self.neighbours(class_id)]
+
+    def __iter__(self):
+        return iter(range(len(self.snapshot)))
+
+    def __len__(self):
+        return len(self.snapshot)
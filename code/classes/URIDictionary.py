@@ -0,0 +1,47 @@
+import numpy as np
+from inpout import inpout
+
+
+class URIDictionary:
+    """
+    Integer codes of the type and category uris. The code of a uri is its position in sorted order, and NAN stands
+    for a missing or unknown uri. The IDF arrays are indexed by code and end with a NaN, so NAN indexes a missing
+    value too.
+    """
+    NAN = -1
+
+    def __init__(self, uris):
+        self.uris = tuple(sorted(set(uris)))
+        self.codes = {u: i for i, u in enumerate(self.uris)}
+
+    def __len__(self):
+        return len(self.uris)
+
+    def __contains__(self, uri):
+        return uri in self.codes
+
+    def encode(self, uri):
+        return self.codes.get(uri, self.NAN)
+
+    def decode(self, code):
+        if code == self.NAN:
+            return None
+        return self.uris[code]
+
+    def idf_array(self, idf):
+        """
+        :param idf: iterable with (uri, idf) pairs
+        :return: array with the idf of each code, NaN for the uris without one
+        """
+        array = np.full(len(self.uris) + 1, np.nan)
+        for uri, value in idf:
+            if uri in self.codes:
+                array[self.codes[uri]] = value
+        return array
+
+    def save(self, filename):
+        inpout.save_iter(self.uris, filename)
+
+    @classmethod
+    def load(cls, filename):
+        return cls(inpout.load_iter(filename))
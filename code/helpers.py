@@ -1,45 +1,119 @@
+import asyncio
+import math
 from collections import Counter, defaultdict
-from utilities import settings
+
+from utilities import metrics, settings
+from utilities.metrics import Timer
 
 
 def match_column(elements, index_name, file_objects):
+    cells = get_cells(elements)
+    objects = initial_objects(cells, file_objects)
+
+    # Cells of the same row are queried one position at a time because each query uses the objects of the
+    # results found for the previous cells of that row. Every row at a position can go in the same batch.
+    # Identical keywords with the same objects are only retrieved once for the whole file.
+    first_results = [[None] * len(c[1]) for c in cells]
+    retrieved = {}
+    with Timer("first_pass"):
+        for i in range(max((len(c[1]) for c in cells), default=0)):
+            queries = [(r, c[1][i][1]) for r, c in enumerate(cells) if i < len(c[1]) and is_keyword(c[1][i][1])]
+            keys = [(keyword, frozenset(objects[r])) for r, keyword in queries]
+            pending = {}
+            for (r, keyword), key in zip(queries, keys):
+                if key not in retrieved and key not in pending:
+                    pending[key] = (keyword, tuple(objects[r]))
+            retrieved.update(zip(pending, settings.EC.search_combined_many(tuple(pending.values()), index=index_name,
+                                                                           size=25, batch_size=settings.BATCH_SIZE)))
+            for (r, keyword), key in zip(queries, keys):
+                first_results[r][i] = retrieved[key]
+                update_objects(objects[r], retrieved[key])
+
+        category_data, type_data, overall_related, categories_final, types_final = collect_first_pass(cells,
+                                                                                                       first_results)
+    with Timer("second_pass"):
+        queries = second_pass_queries(cells, categories_final, types_final)
+        distinct = tuple(dict.fromkeys(q[2:] for q in queries))
+        retrieved = dict(zip(distinct, settings.EC.search_combined2_many(distinct, index=index_name, size=5,
+                                                                         batch_size=settings.BATCH_SIZE)))
+        collect_second_pass(queries, [retrieved[q[2:]] for q in queries], category_data, type_data, overall_related)
+
+    return category_data, type_data, overall_related
+
+
+async def match_column_async(elements, index_name, file_objects, ec):
+    """
+    Same as match_column, but the cells are queried concurrently through an AsyncElasticConnection, which bounds
+    the number of requests in flight. Each row still queries its cells in order, and the second pass only starts
+    once the top categories and types of every column are known.
+    """
+    cells = get_cells(elements)
+    objects = initial_objects(cells, file_objects)
+    retrieved = {}
+
+    async def first_pass(r):
+        results = []
+        for column, keyword in cells[r][1]:
+            result = None
+            if is_keyword(keyword):
+                key = (keyword, frozenset(objects[r]))
+                if key not in retrieved:
+                    retrieved[key] = asyncio.ensure_future(
+                        ec.search_combined(keyword, tuple(objects[r]), index=index_name, size=25))
+                result = await retrieved[key]
+                update_objects(objects[r], result)
+            results.append(result)
+        return results
+
+    with Timer("first_pass"):
+        first_results = await asyncio.gather(*(first_pass(r) for r in range(len(cells))))
+        category_data, type_data, overall_related, categories_final, types_final = collect_first_pass(cells,
+                                                                                                       first_results)
+    with Timer("second_pass"):
+        queries = second_pass_queries(cells, categories_final, types_final)
+        distinct = tuple(dict.fromkeys(q[2:] for q in queries))
+        retrieved = dict(zip(distinct, await asyncio.gather(*(ec.search_combined2(*q, index=index_name, size=5)
+                                                              for q in distinct))))
+        collect_second_pass(queries, [retrieved[q[2:]] for q in queries], category_data, type_data, overall_related)
+
+    return category_data, type_data, overall_related
+
+
+def get_cells(elements):
+    cells = tuple((e[0], tuple((e[1].index.values[i], e[1].iloc[i]) for i in range(len(e[1])))) for e in elements)
+    metrics.count("cells", sum(len(c[1]) for c in cells))
+    return cells
+
+
+def initial_objects(cells, file_objects):
+    if file_objects:
+        return [{z for x in file_objects for z in x[1]} for _ in cells]
+    else:
+        return [set() for _ in cells]
+
+
+def update_objects(objects, results):
+    if results:
+        for r in results:
+            objects.update({z for x in r["_source"]["objects"] for z in x[1]})
+
+
+def collect_first_pass(cells, first_results):
     type_data = []
     category_data = []
     overall_related = {}
     categories = defaultdict(list)
     types = defaultdict(list)
-    elements = tuple(elements)
-    for e in elements:
-        row = e[0]
-        elements_len = len(e[1])
-        if file_objects:
-            objects = {x[1] for x in file_objects}
-        else:
-            objects = set()
-        for i in range(elements_len):
-            column = e[1].index.values[i]
-            keyword = e[1].iloc[i]
-            if keyword != "nan" and keyword is not None:
-                results = settings.EC.search_combined(keyword, tuple(objects), index=index_name, size=25)
-                if results and results is not None:
-                    for r in results:
-                        if r["_source"]["uri"] not in overall_related:
-                            overall_related[r["_source"]["uri"]] = r["_source"]["objects"]
-                        objects.update({z for x in r["_source"]["objects"] for z in x[1]})
-                        if r["_source"]["categories"]:
-                            categories[column].extend(r["_source"]["categories"])
-                        if r["_source"]["types"]:
-                            types[column].extend(r["_source"]["types"])
-                        for cat in r["_source"]["categories"]:
-                            category_data.append((column, row, keyword, r["_source"]["labels"], r["_source"]["uri"],
-                                                  cat, settings.CAT_IDF[cat], r["_norm_score"]))
-
-                        for typ in r["_source"]["types"]:
-                            if "changesets" not in typ and typ != "http://dbpedia.org/ontology/Location":
-                                type_data.append((column, row, keyword, r["_source"]["labels"], r["_source"]["uri"],
-                                                  typ, settings.TYPES_IDF[typ], r["_norm_score"],
-                                                  (settings.GRAPH.get_depths(typ) if typ in settings.GRAPH.depths()
-                                                   else 0.0)))
+    for (row, row_cells), row_results in zip(cells, first_results):
+        for (column, keyword), results in zip(row_cells, row_results):
+            if results:
+                for r in results:
+                    if r["_source"]["categories"]:
+                        categories[column].extend(r["_source"]["categories"])
+                    if r["_source"]["types"]:
+                        types[column].extend(r["_source"]["types"])
+                    add_result(column, row, keyword, r, category_data, type_data, overall_related)
+
     if categories:
         categories_final = {k: get_most_common(v) for k, v in categories.items()}
     else:
@@ -48,48 +122,57 @@ def match_column(elements, index_name, file_objects):
         types_final = {k: get_most_common(v, True) for k, v in types.items()}
     else:
         types_final = {}
-    for e in elements:
-        row = e[0]
-        elements_len = len(e[1])
-        for i in range(elements_len):
-            column = e[1].index.values[i]
-            keyword = e[1].iloc[i]
-            if keyword != "nan" and keyword is not None:
-                if column in categories_final and column in types_final:
-                    results = settings.EC.search_combined2(keyword, categories_final[column], types_final[column],
-                                                           index=index_name, size=5)
-                elif column in types_final and column not in categories_final:
-                    results = settings.EC.search_combined2(keyword, [], types_final[column], index=index_name, size=5)
-                else:
-                    continue
-                if results and results is not None:
-                    for r in results:
-                        if r["_source"]["uri"] not in overall_related:
-                            overall_related[r["_source"]["uri"]] = r["_source"]["objects"]
-                        for cat in r["_source"]["categories"]:
-                            category_data.append((column, row, keyword, r["_source"]["labels"], r["_source"]["uri"],
-                                                  cat, settings.CAT_IDF[cat], r["_norm_score"]))
-
-                        for typ in r["_source"]["types"]:
-                            if "changesets" not in typ and typ != "http://dbpedia.org/ontology/Location":
-                                type_data.append((column, row, keyword, r["_source"]["labels"], r["_source"]["uri"],
-                                                  typ, settings.TYPES_IDF[typ], r["_norm_score"],
-                                                  (settings.GRAPH.get_depths(typ) if typ in settings.GRAPH.depths()
-                                                   else 0.0)))
+    return category_data, type_data, overall_related, categories_final, types_final
 
-    return category_data, type_data, overall_related
+
+def second_pass_queries(cells, categories_final, types_final):
+    queries = []
+    for row, row_cells in cells:
+        for column, keyword in row_cells:
+            if is_keyword(keyword) and column in types_final:
+                queries.append((row, column, keyword, categories_final.get(column, ()), types_final[column]))
+    return queries
+
+
+def collect_second_pass(queries, results, category_data, type_data, overall_related):
+    for (row, column, keyword, _, _), result in zip(queries, results):
+        if result:
+            for r in result:
+                add_result(column, row, keyword, r, category_data, type_data, overall_related)
+
+
+def is_keyword(keyword):
+    return keyword != "nan" and keyword is not None
+
+
+def add_result(column, row, keyword, r, category_data, type_data, overall_related):
+    if r["_source"]["uri"] not in overall_related:
+        overall_related[r["_source"]["uri"]] = r["_source"]["objects"]
+    for cat in r["_source"]["categories"]:
+        code = settings.URIS.encode(cat)
+        category_data.append((column, row, keyword, r["_source"]["labels"], r["_source"]["uri"],
+                              code, settings.CAT_IDF[code], r["_norm_score"]))
+
+    for typ in r["_source"]["types"]:
+        if "changesets" not in typ and typ != "http://dbpedia.org/ontology/Location":
+            code = settings.URIS.encode(typ)
+            type_data.append((column, row, keyword, r["_source"]["labels"], r["_source"]["uri"],
+                              code, settings.TYPES_IDF[code], r["_norm_score"],
+                              (settings.GRAPH.get_depths(typ) if typ in settings.GRAPH.depths()
+                               else 0.0)))
 
 
 def get_most_common(l, types_parse=False):
     counts = Counter(l)
     if types_parse:
-        counts = {k: (v * (settings.GRAPH.get_depths(k) / settings.GRAPH.get_max_depth()) *
-                      settings.TYPES_IDF[k] if
-                      (k in settings.GRAPH.depths() and k in settings.TYPES_IDF) else 0.0)
+        idf = {k: settings.TYPES_IDF[settings.URIS.encode(k)] for k in counts}
+        counts = {k: (v * (settings.GRAPH.get_depths(k) / settings.GRAPH.get_max_depth()) * idf[k] if
+                      (k in settings.GRAPH.depths() and not math.isnan(idf[k])) else 0.0)
                   for k, v in counts.items()}
     else:
         max_c = max(counts.values())
-        counts = {k: ((v / max_c) * settings.CAT_IDF[k] if k in settings.CAT_IDF else 0.0) for k, v in counts.items()}
+        idf = {k: settings.CAT_IDF[settings.URIS.encode(k)] for k in counts}
+        counts = {k: ((v / max_c) * idf[k] if not math.isnan(idf[k]) else 0.0) for k, v in counts.items()}
     sorted_counts = sorted(counts.items(), key=lambda kv: kv[1], reverse=True)
     return tuple(x[0] for x in sorted_counts[:3])
 
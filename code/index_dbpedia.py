@@ -1,83 +1,128 @@
 import argparse
+import heapq
+import json
 import math
-from collections import defaultdict, Counter
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict, Counter, deque
 from datetime import datetime
-from itertools import chain
+from functools import partial
+from itertools import chain, groupby, islice
+from multiprocessing.pool import Pool
+from operator import itemgetter
 from urllib.parse import unquote
 
+import numpy as np
 from inpout import inpout
 from tqdm import tqdm
 
 from classes.ElasticConnection import ElasticConnection
+from classes.URIDictionary import URIDictionary
 from utilities.Configuration import Configuration
-from utilities.general import label_from_url
-
-
-def pack_update(path, filename):
-    types = {}
-    labels = {}
-    with open(filename, "rb") as f, open(path + "update_error_new.log", "wb") as error:
-        for line in tqdm(f, total=516759253, desc="Lines"):
+from utilities.external import external_sort, merge_runs, write_run
+from utilities.files import file_chunks, map_chunks, read_chunk
+from utilities.general import chunks, label_from_url
+
+
+def pack_update(path, filename, chunk_size=64 * 2 ** 20, processes=None):
+    """
+    Packs the changes of the DBpedia Live changeset listing ordered by (date, sequence number). The listing is
+    parsed in chunks by a process pool, each chunk spills its sorted changes to runs that are merged into the packs.
+    """
+    spill_dir = tempfile.mkdtemp(dir=path)
+    runs = {"types": [], "labels": []}
+    lines = 0
+    start = time.time()
+    try:
+        with open(path + "update_error_new.log", "wb") as error:
+            for chunk_runs, errors, chunk_lines in map_chunks(partial(_changes_chunk, spill_dir), filename,
+                                                              chunk_size, processes, desc="Changesets"):
+                for kind, run in chunk_runs.items():
+                    runs[kind].append(run)
+                error.writelines(errors)
+                lines += chunk_lines
+        print(f"Parsed {lines} lines at {lines / (time.time() - start):.0f} lines/s")
+
+        print(f"Packing types")
+        _pack_changes(runs["types"], path + "processed_updates/types_new.mp.lz4")
+        print(f"Packing labels")
+        _pack_changes(runs["labels"], path + "processed_updates/labels_new.mp.lz4")
+    finally:
+        shutil.rmtree(spill_dir)
+
+
+def _changes_chunk(spill_dir, chunk):
+    """
+    Parses the lines of a chunk of the changeset listing and writes a run of the types and labels changes sorted by
+    (date, sequence number), in the order of the lines for the same key.
+    :return: the run filename of each kind, the lines that couldn't be parsed and the number of lines
+    """
+    filename, start, end = chunk
+    changes = {"types": [], "labels": []}
+    errors = []
+    with open(filename, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b"\n")
+    lines = [l + b"\n" for l in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+    for line in lines:
+        try:
+            decoded_line = line.decode("utf8")
+        except UnicodeDecodeError:
+            errors.append(line)
+            continue
+        split_items = decoded_line.split("./downloads.dbpedia.org/live/changesets/")
+        if len(split_items) == 1:
+            split_items = decoded_line.split("dbpedia.org/live/changesets/")
+        if len(split_items) == 1:
+            split_items = decoded_line.split("live/changesets/")
+        if len(split_items) == 1:
+            split_items = decoded_line.split("changesets/")
+        if len(split_items) == 1:
+            split_items = decoded_line.split("downloads.dbpedia.org/live")
+        if len(split_items) == 1:
+            print(line)
+            print(split_items)
+
+        for each in (s for s in split_items if s):
+            split1 = each.split(".nt.gz:")
+            changeset = split1[0]
             try:
-                decoded_line = line.decode("utf8")
-            except UnicodeDecodeError:
-                error.write(line)
+                number_code = [int(d) for d in changeset.split(".")[3].split("/")[3:]]
+                datetime(number_code[0], number_code[1], number_code[2], number_code[3])
+                # Kept as integers in the runs, the date is built when the changes are packed
+                k = (number_code[0], number_code[1], number_code[2], number_code[3], number_code[4])
+                data = split1[1].replace("<", "").replace(" .\n", "").replace("@en", "")
+                triple = data.split("> ")
+                obj = (triple[0].replace(">", ""), triple[2].replace(">", ""))
+            except (IndexError, ValueError) as e:
+                errors.append(line)
                 continue
-            split_items = decoded_line.split("./downloads.dbpedia.org/live/changesets/")
-            if len(split_items) == 1:
-                split_items = decoded_line.split("dbpedia.org/live/changesets/")
-            if len(split_items) == 1:
-                split_items = decoded_line.split("live/changesets/")
-            if len(split_items) == 1:
-                split_items = decoded_line.split("changesets/")
-            if len(split_items) == 1:
-                split_items = decoded_line.split("downloads.dbpedia.org/live")
-            if len(split_items) == 1:
-                print(line)
-                print(split_items)
-
-            for each in (s for s in split_items if s):
-                split1 = each.split(".nt.gz:")
-                filename = split1[0]
-                try:
-                    number_code = [int(d) for d in filename.split(".")[3].split("/")[3:]]
-                    date = datetime(number_code[0], number_code[1], number_code[2], number_code[3])
-                    k = (date, number_code[4])
-                    data = split1[1].replace("<", "").replace(" .\n", "").replace("@en", "")
-                    triple = data.split("> ")
-                    obj = (triple[0].replace(">", ""), triple[2].replace(">", ""))
-                    # if len(split_items) > 1:
-                    #     print(decoded_line)
-                    #     print(split_items)
-                    #     print(k, obj)
-                except (IndexError, ValueError) as e:
-                    error.write(line)
-                    continue
-                if "label" in data:
-                    d_out = labels
-                else:
-                    d_out = types
-                if k not in d_out:
-                    d_out[k] = {}
-                if "added" in filename:
-                    key = "add"
-                elif "reinserted" in filename:
-                    key = "reinsert"
-                else:
-                    key = "remove"
+            if "added" in changeset:
+                key = "add"
+            elif "reinserted" in changeset:
+                key = "reinsert"
+            else:
+                key = "remove"
+            changes["labels" if "label" in data else "types"].append((k, key, obj))
+
+    runs = {}
+    for kind, items in changes.items():
+        if items:
+            items.sort(key=itemgetter(0))
+            runs[kind] = os.path.join(spill_dir, f"{kind}_{start:015d}.run")
+            write_run(items, runs[kind])
+    return runs, errors, len(lines)
 
-                if key not in d_out[k]:
-                    d_out[k][key] = []
-                d_out[k][key].append(obj)
 
-    print(f"Packing types")
-    with inpout.data_pack(path + "processed_updates/types_new.mp.lz4") as pack:
-        for t in sorted(types.items(), key=lambda kv: (kv[0][0], kv[0][1])):
-            pack(t)
-    print(f"Packing labels")
-    with inpout.data_pack(path + "processed_updates/labels_new.mp.lz4") as pack:
-        for t in sorted(labels.items(), key=lambda kv: (kv[0][0], kv[0][1])):
-            pack(t)
+def _pack_changes(runs, filename):
+    with inpout.data_pack(filename) as pack:
+        for k, group in groupby(merge_runs(runs, itemgetter(0)), key=itemgetter(0)):
+            changes = {}
+            for _, key, obj in group:
+                changes.setdefault(key, []).append(tuple(obj))
+            pack(((datetime(*k[:4]), k[4]), changes))
 
 
 def update_files(triples, update_file, output, redirects, labels=False):
@@ -106,112 +151,121 @@ def update_files(triples, update_file, output, redirects, labels=False):
                     out.write("<" + uri + "> " + "<label>" + " \"" + each + "\" . \n")
 
 
+def stream_update(base_file, update_file, output, tmp_dir=None, run_size=1000000):
+    """
+    Applies the changesets to the triples of a dump and packs the result without loading either of them. The dump and
+    the changes are sorted by uri with an external sort and merged, and the changes of each uri are applied in
+    changeset order. Unlike update_files, the removed triples are deleted.
+    """
+    base = external_sort(_base_triples(base_file), itemgetter(0), run_size, tmp_dir)
+    changes = external_sort(_changes(update_file), itemgetter(0), run_size, tmp_dir)
+    inpout.save_iter(tqdm(_apply_changes(base, changes), desc="Writing"), output)
+
+
+def _base_triples(filename):
+    for start, end in tqdm(tuple(file_chunks(filename, 64 * 2 ** 20)), desc=filename.split("/")[-1]):
+        for triple in parse_lines(filename, start, end):
+            yield triple[0], triple[2]
+
+
+def _changes(update_file):
+    with inpout.data_unpacker(update_file, use_list=False) as unpacker:
+        for date, obj in tqdm(unpacker, desc="Changes"):
+            for action, changes in obj.items():
+                for original, change in changes:
+                    if "http://dbpedia.org/resource/" in original:
+                        change = change.replace("@en", "").replace(".\n", "").replace("\"", "")
+                        if "http" not in change:
+                            yield original, action != "remove", change
+
+
+def _apply_changes(base, changes):
+    """Yields the uri and the set of objects of each resource, the base triples of a uri come before its changes."""
+    merged = heapq.merge(((uri, 0, each, True) for uri, each in base),
+                         ((uri, 1, change, add) for uri, add, change in changes), key=itemgetter(0, 1))
+    for uri, group in groupby(merged, key=itemgetter(0)):
+        objects = set()
+        for _, _, each, add in group:
+            if add:
+                objects.add(each)
+            else:
+                objects.discard(each)
+        if objects:
+            yield uri, objects
+
+
 def parse_triple(line):
     return tuple(t.replace("<", "").replace("\"", "").replace("@en", "").replace(" .", "")
                  for t in line.strip().split("> "))
 
 
-def read_triples(filename, name="Triples"):
+def parse_lines(filename, start, end):
+    for line in read_chunk(filename, start, end):
+        if line.startswith("<"):
+            yield parse_triple(line)
+
+
+def _triples_chunk(chunk):
     triples = defaultdict(set)
-    with open(filename) as f:
-        for line in tqdm(f, total=sum(1 for _ in open(filename)), desc=name):
-            if line.startswith("<"):
-                triple = parse_triple(line)
-                if triple[2] not in triples[triple[0]]:
-                    triples[triple[0]].add(triple[2])
+    for triple in parse_lines(*chunk):
+        triples[triple[0]].add(triple[2])
     return triples
 
 
-def read_spo(filename, name="spo"):
-    triples = defaultdict(lambda: defaultdict(set))
-    with open(filename) as f:
-        for line in tqdm(f, total=sum(1 for _ in open(filename)), desc=name):
-            if line.startswith("<"):
-                triple = parse_triple(line)
-                if triple[2] not in triples[triple[0]]:
-                    triples[triple[0]][triple[1]].add(triple[2])
+def _spo_chunk(chunk):
+    triples = {}
+    for triple in parse_lines(*chunk):
+        if triple[2] not in triples.get(triple[0], ()):
+            triples.setdefault(triple[0], {}).setdefault(triple[1], set()).add(triple[2])
     return triples
 
 
-def parse_redirects(fredirect):
-    num_lines2 = sum(1 for _ in open(fredirect))
-    triples = {}
-    with open(fredirect) as fr:
-        for line in tqdm(fr, total=num_lines2, desc="Redirects"):
-            if line.startswith("<"):
-                triple = parse_triple(line)
-                triples[triple[0]] = triple[2]
+def _redirects_chunk(chunk):
+    return {triple[0]: triple[2] for triple in parse_lines(*chunk)}
 
-    return triples
 
+def read_triples(filename, name="Triples", processes=None):
+    triples = defaultdict(set)
+    for part in map_chunks(_triples_chunk, filename, processes=processes, desc=name):
+        for subject, objects in part.items():
+            if subject in triples:
+                triples[subject].update(objects)
+            else:
+                triples[subject] = objects
+    return triples
 
-def create_index(types_file, labels_file, objects_file, categories_file, disam_file, redirects, language, ec, ids=None):
-    merged = defaultdict(list)
-    for k, v in tqdm(inpout.load_iter(labels_file), desc="Labels"):
-        uri, r = redirect(k, redirects)
-        merged[uri].append(("label", v, r))
-    for k, v in tqdm(inpout.load_iter(types_file), desc="Types"):
-        uri, r = redirect(k, redirects)
-        merged[uri].append(("types", set(t for t in v if "http://dbpedia.org/ontology/" in t and
-                         "Wikidata" not in t and "purl.org" not in t), False))
-    for k, v in tqdm(inpout.load_iter(objects_file), desc="Objects"):
-        uri, r = redirect(k, redirects)
-        merged[uri].append(("objects", v, False))
-    for k, v in tqdm(inpout.load_iter(categories_file), desc="categories"):
-        uri, r = redirect(k, redirects)
-        merged[uri].append(("categories", set(v), False))
-    for k, v in tqdm(inpout.load_iter(disam_file), desc="Disam"):
-        uri, r = redirect(k, redirects)
-        merged[uri].append(("disam", v, False))
 
-    all_items = ("types", "objects", "categories", "disam")
-    documents = []
-    for uri, items in tqdm(merged.items(), desc="Processing"):
-        document = defaultdict(set)
-        document["uri"] = uri
-        labels = set()
-        redirected = {}
-        cont_processing = True
-        for name, item, rd in items:
-            if name == "label":
-                l = item.pop()
-                if "disambiguation" in l:
-                    cont_processing = False
-                    break
-                labels.add(l)
-                if rd:
-                    redirected[l] = "redirected"
-                else:
-                    redirected[l] = "original"
-            elif name == "objects":
-                # TODO: Test if it worked
-                pair = tuple(map(lambda x: (x[0], tuple(x[1])), (y for y in item.items() if y[0] != "http://dbpedia.org/ontology/type")))
-                document[name].update(pair)
-                document["related"] = (y[0] for y in item.items() if y[0] != "http://dbpedia.org/ontology/type")
+def read_spo(filename, name="spo", processes=None):
+    triples = {}
+    for part in map_chunks(_spo_chunk, filename, processes=processes, desc=name):
+        for subject, predicates in part.items():
+            if subject in triples:
+                for predicate, objects in predicates.items():
+                    triples[subject].setdefault(predicate, set()).update(objects)
             else:
-                document[name].update(item)
-        if cont_processing:
-            if not labels:
-                label = label_from_url(uri)
-                labels.add(label)
-                redirected[label] = "from_uri"
-            if len(document.keys()) == 1:
-                continue
+                triples[subject] = predicates
+    return triples
+
+
+def parse_redirects(fredirect, processes=None):
+    triples = {}
+    for part in map_chunks(_redirects_chunk, fredirect, processes=processes, desc="Redirects"):
+        triples.update(part)
+    return triples
 
-            for each in all_items:
-                if each not in document:
-                    document[each] = ()
-                else:
-                    document[each] = tuple(document[each])
 
-            document["labels"] = list(labels)
-            documents.append(document)
+def create_index(types_file, labels_file, objects_file, categories_file, disam_file, redirects, language, ec, ids=None,
+                 tmp_dir=None, run_size=1000000, adaptive=False):
+    artifacts = (("label", labels_file), ("types", types_file), ("objects", objects_file),
+                 ("categories", categories_file), ("disam", disam_file))
+    merged = merge_artifacts(artifacts, redirects, tmp_dir, run_size)
 
     print("Creating index...")
     index_name = "dbpedia4"
     if ec.index_exists(index_name):
          ec.delete_index(index_name)
-    ec.add_index(index_name, tuple(documents), body={
+    # Documents are built while they are indexed, at most queue_size chunks wait for the bulk threads
+    ec.add_index(index_name, build_documents(merged), body={
         "mappings": {"properties": {
             "uri": {
                 "type": "keyword"
@@ -223,7 +277,218 @@ def create_index(types_file, labels_file, objects_file, categories_file, disam_f
                 "type": "text"
             }
         }}
-    }, overwrite=False)
+    }, overwrite=False, queue_size=4, adaptive=adaptive)
+
+
+def update_index(ec, index_name, changesets, watermark_file, redirects, chunk_size=500):
+    """
+    Applies the changesets packed by pack_update that are newer than the watermark to the documents of the index,
+    instead of rebuilding it. Only the documents of the changed resources are updated, deleted or added. The
+    changes of objects are skipped, the packs don't keep the predicate of the triples.
+    :param changesets: dictionary with the filename of the "types" and "labels" packs
+    """
+    if not ec.has_keyword(index_name, "uri"):
+        raise ValueError(f"{index_name} has no uri.keyword field, the changed resources can't be found")
+    watermark = read_watermark(watermark_file)
+    changes, last, skipped = changed_resources(changesets, watermark, redirects)
+    if skipped:
+        print(f"Skipped {skipped} changes of objects and non-indexed types")
+    if not changes:
+        print("No new changes")
+        return
+    generated = Counter()
+    applied = ec.bulk(index_name, update_actions(ec, index_name, changes, chunk_size, generated), chunk_size)
+    print(f"Applied the changes of {applied} resources out of {len(changes)}")
+    # The watermark only moves once every action succeeded, otherwise the failed changes would never be applied
+    if applied < generated["actions"]:
+        raise RuntimeError(f'{generated["actions"] - applied} of {generated["actions"]} actions failed, '
+                           f"the watermark stays at {watermark}")
+    write_watermark(watermark_file, last)
+    # Also invalidates the cached queries of the index
+    ec.set_meta(index_name, {"watermark": last[0].isoformat(), "seq": last[1]})
+
+
+def read_watermark(filename):
+    if os.path.exists(filename):
+        with open(filename) as f:
+            watermark = json.load(f)
+        return datetime.fromisoformat(watermark["date"]), watermark["seq"]
+
+
+def write_watermark(filename, key):
+    with open(filename, "w") as f:
+        json.dump({"date": key[0].isoformat(), "seq": key[1]}, f)
+
+
+def changed_resources(changesets, watermark, redirects):
+    """
+    :return: dictionary with the (field, added, value) changes of each resource in changeset order, the last
+    (date, seq) and the number of changes that can't be applied
+    """
+    changes = defaultdict(list)
+    last = watermark
+    skipped = 0
+    for kind, filename in changesets.items():
+        for key, actions in tqdm(inpout.load_iter(filename), desc=filename.split("/")[-1]):
+            key = tuple(key)
+            if watermark is not None and key <= watermark:
+                continue
+            if last is None or key > last:
+                last = key
+            for action, triples in actions.items():
+                for subject, value in triples:
+                    if "http://dbpedia.org/resource/" not in subject:
+                        continue
+                    field, value = classify_change(kind, value)
+                    if field is None:
+                        skipped += 1
+                        continue
+                    changes[redirect(subject, redirects)[0]].append((field, action != "remove", value))
+    return changes, last, skipped
+
+
+def classify_change(kind, value):
+    """
+    Returns the document field changed by a changeset triple with this object, None if it isn't indexed. Labels
+    only come from the labels pack, and types and categories from the types pack.
+    """
+    if kind == "labels":
+        return "labels", value.replace("@en", "").replace(".\n", "").replace("\"", "")
+    if value.startswith("http://dbpedia.org/resource/Category:"):
+        return "categories", value
+    if is_indexed_type(value):
+        return "types", value
+    return None, value
+
+
+def update_actions(ec, index_name, changes, chunk_size=500, generated=None):
+    """
+    :param generated: Counter where the number of actions yielded is added as "actions"
+    """
+    for batch in chunks(tuple(changes), chunk_size):
+        hits = ec.find_uris(index_name, batch)
+        for uri in batch:
+            if uri in hits:
+                action = update_action(hits[uri], changes[uri])
+            else:
+                action = new_document_action(uri, changes[uri])
+            if action is not None:
+                if generated is not None:
+                    generated["actions"] += 1
+                yield action
+
+
+def apply_changes(fields, changes):
+    for field, added, value in changes:
+        if added:
+            fields[field].add(value)
+        else:
+            fields[field].discard(value)
+    return fields
+
+
+def update_action(hit, changes):
+    source = hit["_source"]
+    fields = apply_changes({f: set(source.get(f, ())) for f in ("labels", "types", "categories")}, changes)
+    # The documents build_document skips: disambiguations and resources with nothing but labels
+    if any("disambiguation" in l for l in fields["labels"]) or \
+            not fields["types"] and not fields["categories"] and not source.get("objects") and not source.get("disam"):
+        return {"_op_type": "delete", "_id": hit["_id"]}
+    if not fields["labels"]:
+        fields["labels"].add(label_from_url(source["uri"]))
+    return {"_op_type": "update", "_id": hit["_id"], "doc": {f: list(v) for f, v in fields.items()}}
+
+
+def new_document_action(uri, changes):
+    fields = apply_changes({"labels": set(), "types": set(), "categories": set()}, changes)
+    items = [("label", [l], False) for l in fields["labels"]]
+    items.extend((f, fields[f], False) for f in ("types", "categories") if fields[f])
+    document = build_document(uri, items)
+    if document is not None:
+        return {"_op_type": "index", "_source": document}
+
+
+def artifact_items(name, filename, redirects):
+    for k, v in tqdm(inpout.load_iter(filename), desc=name.capitalize()):
+        uri, r = redirect(k, redirects)
+        if name == "label":
+            yield uri, (name, v, r)
+        elif name == "types":
+            yield uri, (name, set(t for t in v if is_indexed_type(t)), False)
+        elif name == "categories":
+            yield uri, (name, set(v), False)
+        else:
+            yield uri, (name, v, False)
+
+
+def merge_artifacts(artifacts, redirects, tmp_dir=None, run_size=1000000):
+    """
+    Joins the packed artifacts by resource uri, after resolving the redirects, without loading them in memory. Each
+    artifact is sorted by uri with an external sort and the sorted streams are merged.
+    :param artifacts: sequence of (name, filename) pairs
+    :return: generator with the uri of each resource and the list of its (name, item, redirected) items, in the order
+    of the artifacts
+    """
+    streams = tuple(external_sort(artifact_items(name, filename, redirects), itemgetter(0), run_size, tmp_dir)
+                    for name, filename in artifacts)
+    for uri, group in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        yield uri, [item for _, item in group]
+
+
+def build_documents(merged):
+    """
+    :param merged: iterable with the uri of each resource and the list of (name, item, redirected) items merged for it
+    :return: generator with the document of each resource to index
+    """
+    for uri, items in tqdm(merged, desc="Processing"):
+        document = build_document(uri, items)
+        if document is not None:
+            yield document
+
+
+def build_document(uri, items):
+    """Returns the document of a resource, None if it's a disambiguation or it has nothing but labels."""
+    all_items = ("types", "objects", "categories", "disam")
+    document = defaultdict(set)
+    document["uri"] = uri
+    labels = set()
+    redirected = {}
+    for name, item, rd in items:
+        if name == "label":
+            l = item.pop()
+            if "disambiguation" in l:
+                return None
+            labels.add(l)
+            if rd:
+                redirected[l] = "redirected"
+            else:
+                redirected[l] = "original"
+        elif name == "objects":
+            # TODO: Test if it worked
+            pair = tuple(map(lambda x: (x[0], tuple(x[1])), (y for y in item.items() if y[0] != "http://dbpedia.org/ontology/type")))
+            document[name].update(pair)
+            document["related"] = (y[0] for y in item.items() if y[0] != "http://dbpedia.org/ontology/type")
+        else:
+            document[name].update(item)
+    if not labels:
+        label = label_from_url(uri)
+        labels.add(label)
+        redirected[label] = "from_uri"
+    if len(document.keys()) == 1:
+        return None
+
+    for each in all_items:
+        if each not in document:
+            document[each] = ()
+        else:
+            document[each] = tuple(document[each])
+
+    document["labels"] = list(labels)
+    return document
+
+
+def is_indexed_type(t):
+    return "http://dbpedia.org/ontology/" in t and "Wikidata" not in t and "purl.org" not in t
 
 
 def redirect(uri, redirects):
@@ -233,22 +498,63 @@ def redirect(uri, redirects):
         return unquote(uri), False
 
 
-def calculate_idf(d):
-    chain_values = tuple(chain(*d.values()))
-    set_values = set(chain_values)
-    N = len(set_values)
-    counter = Counter(chain_values)
-    idf_dict = {}
-    for v in tqdm(set_values, desc="Values"):
-        idf_dict[v] = math.log10(N / counter[v])
-    return idf_dict
+def calculate_idf(counts):
+    """
+    :param counts: Counter with the number of resources of each value
+    :return: dictionary with the IDF of each value, the number of documents being the number of distinct values
+    """
+    N = len(counts)
+    return {v: math.log10(N / c) for v, c in counts.items()}
+
+
+def _count_batch(batch):
+    return Counter(chain.from_iterable(batch))
+
+
+def count_values(filename, pool=None, batch_size=100000, max_pending=2):
+    """
+    Counts the values of a packed mapping while it is read. With a pool, batches of values are counted by the
+    workers and their counters merged, at most max_pending batches wait to be counted.
+    """
+    values = (v for _, v in tqdm(inpout.load_iter(filename), desc=filename.split("/")[-1]))
+    if pool is None:
+        return _count_batch(values)
+    counts = Counter()
+    pending = deque()
+    for batch in iter(lambda: tuple(islice(values, batch_size)), ()):
+        pending.append(pool.apply_async(_count_batch, (batch,)))
+        if len(pending) >= max_pending:
+            counts.update(pending.popleft().get())
+    while pending:
+        counts.update(pending.popleft().get())
+    return counts
+
+
+def stream_idf(jobs, processes=1):
+    """
+    :param jobs: pairs of (packed mapping, IDF pack) filenames
+    :param processes: number of processes counting the values, 1 to count them in the reading process
+    :return: list with the IDF dictionary of each mapping
+    """
+    if processes > 1:
+        with Pool(processes) as pool:
+            return [_idf_job(filename, outfile, pool, 2 * processes) for filename, outfile in jobs]
+    return [_idf_job(filename, outfile) for filename, outfile in jobs]
+
+
+def _idf_job(filename, outfile, pool=None, max_pending=2):
+    idf = calculate_idf(count_values(filename, pool, max_pending=max_pending))
+    inpout.save_iter(idf.items(), outfile)
+    return idf
 
 
-def load_and_idf(filename, outfile):
-    print(f"Loading {filename}")
-    d = dict(inpout.load_iter(filename))
-    idf = calculate_idf(d)
-    inpout.save_iter(idf.items(), outfile)
+def write_uri_dictionary(folder, categories_idf, types_idf):
+    """Encodes the categories and types with an IDF and saves the IDF arrays indexed by their codes."""
+    dictionary = URIDictionary(chain(categories_idf, types_idf))
+    print(f"Encoded {len(dictionary)} uris")
+    dictionary.save(folder + "uri_dictionary.mp.lz4")
+    np.save(folder + "categories_idf.npy", dictionary.idf_array(categories_idf.items()))
+    np.save(folder + "types_idf.npy", dictionary.idf_array(types_idf.items()))
 
 def main(args):
     config = Configuration(args.config)
@@ -264,14 +570,27 @@ def main(args):
         print("Reading redirects...")
         redirects = dict(inpout.load_iter(folder + "redirects.mp.lz4", use_list=False))
 
-    if args.update_types:
+    if args.incremental_update:
+        update_index(ElasticConnection(config.ehost, config.eport), "dbpedia4",
+                     {"types": folder + "processed_updates/types_new.mp.lz4",
+                      "labels": folder + "processed_updates/labels_new.mp.lz4"},
+                     folder + "processed_updates/watermark.json", redirects)
+        return
+
+    if args.update_types and args.stream_updates:
+        stream_update(folder + "types/instance_types_en.ttl", folder + "processed_updates/types.mp.lz4",
+                      folder + "types/updated_types.mp.lz4", tmp_dir=folder)
+    elif args.update_types:
         update_files(read_triples(folder + "types/instance_types_en.ttl"),
                      folder + "processed_updates/types.mp.lz4",
                      folder + "types/updated_types.ttl", redirects)
         type_triples = read_triples(folder + f"types/updated_types.ttl", "Types")
         print("Packing types...")
         inpout.save_iter(type_triples.items(), folder + "types/updated_types.mp.lz4")
-    if args.update_labels:
+    if args.update_labels and args.stream_updates:
+        stream_update(folder + "labels/labels_en.ttl", folder + "processed_updates/labels.mp.lz4",
+                      folder + "labels/updated_labels.mp.lz4", tmp_dir=folder)
+    elif args.update_labels:
         update_files(read_triples(folder + "labels/labels_en.ttl"),
                      folder + "processed_updates/labels.mp.lz4",
                      folder + "labels/updated_labels.ttl", redirects, True)
@@ -293,8 +612,11 @@ def main(args):
         inpout.save_iter(disam.items(), folder + "disambiguations_en.mp.lz4")
 
     if args.idf:
-        load_and_idf(folder + "article_categories_en.mp.lz4", folder + "categories_idf.mp.lz4")
-        load_and_idf(folder + f"types/updated_types.mp.lz4", folder + "types_idf.mp.lz4")
+        categories_idf, types_idf = stream_idf(((folder + "article_categories_en.mp.lz4",
+                                                  folder + "categories_idf.mp.lz4"),
+                                                 (folder + f"types/updated_types.mp.lz4", folder + "types_idf.mp.lz4")),
+                                                args.idf_processes)
+        write_uri_dictionary(folder, categories_idf, types_idf)
 
     ec = ElasticConnection(config.ehost, config.eport)
 
@@ -303,7 +625,7 @@ def main(args):
     categories_file = folder + "article_categories_en.mp.lz4"
     disam_file = folder + "disambiguations_en.mp.lz4"
     create_index(types_file, folder + "labels/updated_labels.mp.lz4", objects_file, categories_file,
-                     disam_file, redirects, "en", ec)
+                     disam_file, redirects, "en", ec, tmp_dir=folder, adaptive=args.adaptive_bulk)
 
 if __name__ == "__main__":
     PARSER = argparse.ArgumentParser(description='')
@@ -316,5 +638,13 @@ if __name__ == "__main__":
     PARSER.add_argument("-pd", "--pack_disambiguations", action="store_true")
     PARSER.add_argument("-ut", "--update_types", action="store_true")
     PARSER.add_argument("-ul", "--update_labels", action="store_true")
+    PARSER.add_argument("-su", "--stream_updates", action="store_true",
+                        help="Apply the changesets to the sorted dumps and pack them without the updated TTL.")
+    PARSER.add_argument("-iu", "--incremental_update", action="store_true",
+                        help="Apply the packed changesets newer than the watermark to the index instead of rebuilding it.")
+    PARSER.add_argument("-ab", "--adaptive_bulk", action="store_true",
+                        help="Index with byte-sized chunks and a concurrency adapted to the rejections of the cluster.")
     PARSER.add_argument("-idf", "--idf", action="store_true")
+    PARSER.add_argument("-j", "--idf-processes", type=int, default=1,
+                        help="Processes counting the categories and types for the IDF.")
     main(PARSER.parse_args())
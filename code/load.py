@@ -11,6 +11,9 @@ from utilities.Configuration import Configuration
 def main(args):
     config = Configuration(args.config_file)
     graph = ArangoSchemaGraph(config)
+    if args.export_snapshot:
+        graph.export_snapshot(config.snapshot)
+        return
     graph.init()
     a = input("Are you sure you want to load? (y/n) ")
     if a == "y":
@@ -20,6 +23,10 @@ def main(args):
                               glob.glob(config.ontology_dir + "*"))
         graph.load_mappings(config.map_file)
         graph.calculate_properties()
+        if config.snapshot:
+            graph.export_snapshot(config.snapshot)
+        if config.distances:
+            graph.oracle().precompute(graph.ontology(), config.distances)
 
         ec = ElasticConnection(config.ehost, config.eport)
         index_name = config.prefix + "classes"
@@ -52,4 +59,6 @@ if __name__ == "__main__":
     PARSER.add_argument("-n", "--name", type=str, help="DB name", default="")
     PARSER.add_argument("-hes", "--elasticsearch-host", type=str, help="Elastic search address", default="")
     PARSER.add_argument("-pes", "--elasticsearch-port", type=str, help="Elastics search port", default="")
+    PARSER.add_argument("-s", "--export-snapshot", action="store_true",
+                        help="Only export the ontology snapshot of the loaded database.")
     main(PARSER.parse_args())
@@ -13,6 +13,8 @@ class Configuration:
         self.task = self._add_option("DEFAULT", "task")
         self.output_dir = self._add_option("DEFAULT", "outdir", True)
         self.update_file = self._add_option("DEFAULT", "updatefile", False)
+        self.metrics = self._add_option("DEFAULT", "metrics")
+        self.profile = float(self._add_option("DEFAULT", "profile") or 0)
 
         self.data = self._add_option("DEFAULT", "data")
         self.map_file = self._add_option("DEFAULT", "mappings")
@@ -21,9 +23,16 @@ class Configuration:
         self.aport = self._add_option("Arangodb", "port")
         self.ahost = self._add_option("Arangodb", "host")
         self.adb = self._add_option("Arangodb", "database")
+        self.snapshot = self._add_option("Arangodb", "snapshot")
+        self.distances = self._add_option("Arangodb", "distances")
 
         self.ehost = self._add_option("Elasticsearch", "host")
         self.eport = self._add_option("Elasticsearch", "port")
+        self.batch_size = int(self._add_option("Elasticsearch", "batchsize") or 0)
+        self.max_in_flight = int(self._add_option("Elasticsearch", "maxinflight") or 0)
+        self.cache_file = self._add_option("Elasticsearch", "cachefile")
+        self.cache_size = int(self._add_option("Elasticsearch", "cachesize") or 10000)
+        self.cache_disk_size = int(self._add_option("Elasticsearch", "cachedisksize") or 1000000)
         self.prefix = self._add_option("DEFAULT", "prefix")
 
     def _add_option(self, field1, field2, directory=False):
@@ -0,0 +1,69 @@
+import heapq
+import os
+import shutil
+import tempfile
+from itertools import islice
+
+from utilities import packing
+
+
+def write_run(items, filename):
+    with open(filename, "wb") as f:
+        packer = packing.packer()
+        for item in items:
+            f.write(packer.pack(item))
+
+
+def read_run(filename):
+    with open(filename, "rb") as f:
+        for item in packing.unpacker(f):
+            yield item
+
+
+def merge_runs(filenames, key, max_fan_in=256):
+    """
+    Merges sorted runs, items with the same key come out in the order of the runs. At most max_fan_in runs are open at
+    the same time: consecutive groups of runs are merged into intermediate runs, next to the first run, until
+    max_fan_in runs are left.
+    """
+    filenames = list(filenames)
+    if len(filenames) <= max_fan_in:
+        yield from heapq.merge(*(read_run(f) for f in filenames), key=key)
+        return
+    directory = tempfile.mkdtemp(dir=os.path.dirname(filenames[0]))
+    try:
+        level = 0
+        while len(filenames) > max_fan_in:
+            merged = []
+            for i in range(0, len(filenames), max_fan_in):
+                merged.append(os.path.join(directory, f"{level}_{len(merged)}.run"))
+                write_run(heapq.merge(*(read_run(f) for f in filenames[i:i + max_fan_in]), key=key), merged[-1])
+                if level:
+                    for f in filenames[i:i + max_fan_in]:
+                        os.remove(f)
+            filenames = merged
+            level += 1
+        yield from heapq.merge(*(read_run(f) for f in filenames), key=key)
+    finally:
+        shutil.rmtree(directory)
+
+
+def external_sort(items, key, run_size=1000000, tmp_dir=None):
+    """
+    Sorts items that don't fit in memory. Sorted runs of run_size items are spilled to temporary files, which are
+    merged while the result is read and deleted afterwards. The sort is stable. Tuples come back as lists.
+    """
+    directory = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        runs = []
+        items = iter(items)
+        while True:
+            run = list(islice(items, run_size))
+            if not run:
+                break
+            run.sort(key=key)
+            runs.append(os.path.join(directory, f"{len(runs)}.run"))
+            write_run(run, runs[-1])
+        yield from merge_runs(runs, key)
+    finally:
+        shutil.rmtree(directory)
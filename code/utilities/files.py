@@ -0,0 +1,49 @@
+import os
+from collections import deque
+from multiprocessing.pool import Pool
+
+from tqdm import tqdm
+
+
+def file_chunks(filename, chunk_size):
+    """Yields (start, end) byte offsets of consecutive parts of the file that start and end at line boundaries."""
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = f.tell()
+            yield start, end
+            start = end
+
+
+def read_chunk(filename, start, end):
+    """Returns the lines between the byte offsets start and end."""
+    with open(filename, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf8").split("\n")
+
+
+def map_chunks(function, filename, chunk_size=64 * 2 ** 20, processes=None, desc=None, max_pending=None):
+    """
+    Applies function to every (filename, start, end) chunk of the file in a process pool and yields the results in
+    the order of the chunks. The progress is reported in bytes read.
+    :param max_pending: number of chunks submitted and not yet yielded, twice the number of processes by default, so
+    the results don't pile up when they are consumed slower than they are computed
+    """
+    if max_pending is None:
+        max_pending = 2 * (processes or os.cpu_count())
+    pending = deque()
+    with Pool(processes) as pool, tqdm(total=os.path.getsize(filename), unit="B", unit_scale=True,
+                                       desc=desc) as progress:
+        for start, end in file_chunks(filename, chunk_size):
+            pending.append((end - start, pool.apply_async(function, ((filename, start, end),))))
+            if len(pending) >= max_pending:
+                size, result = pending.popleft()
+                progress.update(size)
+                yield result.get()
+        while pending:
+            size, result = pending.popleft()
+            progress.update(size)
+            yield result.get()
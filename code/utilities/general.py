@@ -1,6 +1,7 @@
 import re
 import string
 from base64 import b32encode
+from functools import lru_cache
 
 from urllib.parse import unquote
 
@@ -12,36 +13,46 @@ from ftfy.fixes import fix_partial_utf8_punct_in_1252, decode_escapes, remove_bo
 from pandas import isnull
 
 
+LETTER = re.compile('[a-zA-Z]')
+CAMEL_CASE = re.compile(r"^\w+[A-Z]{1}\w*$")
+CAMEL_CASE_WORD = re.compile('(?!^)([A-Z][a-z]+)')
+BRACKETS = re.compile(r'[\[\]()]')
+# ASCII text without HTML entities, backslash escapes or control characters is not changed by the ftfy fixes
+PLAIN_ASCII = re.compile(r'[\t\n\x20-\x25\x27-\x5b\x5d-\x7e]*')
+
+
 def clean_string(s):
     s = str(s)
     if isnull(s):
         return None
-    elif re.search('[a-zA-Z]', s) is None:
+    elif LETTER.search(s) is None:
         return None
     else:
-        s = remove_bom(s)
-        s = remove_control_chars(s)
-        s = fix_encoding(s)
-        s = fix_text(s)
-        s = fix_partial_utf8_punct_in_1252(s)
-        s = decode_escapes(s)
-        s = fix_latin_ligatures(s)
-        s = uncurl_quotes(s)
-        s = s.replace("Äu0087", "ć")
-        s = s.replace("Äu0090", "Đ")
-        s = s.replace("Ãu0096", "Ö")
-        s = s.replace("Åu008D", "ō")
+        if not PLAIN_ASCII.fullmatch(s):
+            s = remove_bom(s)
+            s = remove_control_chars(s)
+            s = fix_encoding(s)
+            s = fix_text(s)
+            s = fix_partial_utf8_punct_in_1252(s)
+            s = decode_escapes(s)
+            s = fix_latin_ligatures(s)
+            s = uncurl_quotes(s)
+            s = s.replace("Äu0087", "ć")
+            s = s.replace("Äu0090", "Đ")
+            s = s.replace("Ãu0096", "Ö")
+            s = s.replace("Åu008D", "ō")
 
         s = s.replace("\\", " ")
         s = s.replace("/", " ")
         s = s.replace("Ã¶", "ö")
 
-        p = re.compile("^\w+[A-Z]{1}\w*$")
-        if p.search(s):
+        if CAMEL_CASE.search(s):
             # From: https://stackoverflow.com/a/37697078
-            s = re.sub('(?!^)([A-Z][a-z]+)', r'\1', s)
+            s = CAMEL_CASE_WORD.sub(r'\1', s)
 
-        new_string = ""
+        if BRACKETS.search(s) is None:
+            return s.strip()
+        new_string = []
         p = False
         for letter in s:
             if letter in "([":
@@ -50,8 +61,18 @@ def clean_string(s):
                 p = False
                 continue
             if not p:
-                new_string += letter
-        return new_string.strip()
+                new_string.append(letter)
+        return "".join(new_string).strip()
+
+
+# Shared by all the tables cleaned in the same process
+cached_clean_string = lru_cache(maxsize=100000, typed=True)(clean_string)
+
+
+def clean_frame(data):
+    """Applies clean_string to every cell of data, cleaning each distinct value only once."""
+    return data.apply(lambda column: column.map(cached_clean_string))
+
 
 def remove_brackets(s):
     new = ""
@@ -69,22 +90,63 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+
+@lru_cache(maxsize=100000)
+def normalise_term(s):
+    """Returns the form of s compared by levenshtein_similarity and whether it starts with an initial, e.g. 'j. doe'."""
+    s = s.lower().strip().replace("–", "")
+    return remove_brackets(s).translate(PUNCTUATION), len(s) > 1 and s[1] == "."
+
+
+@lru_cache(maxsize=100000)
+def normalise_label(s, initial=False):
+    """Returns the form of s compared by levenshtein_similarity, abbreviating the first name if the term has one."""
+    s = s.lower().strip().replace("–", "")
+    if s and initial:
+        split_s = s.split(" ")
+        s = split_s[0][0] + ". " + " ".join(split_s[1:])
+    return remove_brackets(s).translate(PUNCTUATION)
+
+
 def levenshtein_similarity(s1, s2):
-    s1 = s1.lower().strip().replace("–", "")
-    s2 = s2.lower().strip().replace("–", "")
-    if s1 and s2 and len(s1) > 1:
-        new_s2 = ""
-        if s1[1] == ".":
-            split_s2 = s2.split(" ")
-            new_s2 += split_s2[0][0] + ". " + " ".join(split_s2[1:])
-            s2 = new_s2
-    s1 = remove_brackets(s1).translate(str.maketrans('', '', string.punctuation))
-    s2 = remove_brackets(s2).translate(str.maketrans('', '', string.punctuation))
+    s1, initial = normalise_term(s1)
+    s2 = normalise_label(s2, initial)
     if s1 and s2:
         return 1 - (Levenshtein.distance(s1, s2) / max(len(s1), len(s2)))
     else:
         return 0.0
 
 
+def max_similarity(terms, labels):
+    """
+    :param terms: sequence of keywords
+    :param labels: sequence with the list of labels of each keyword
+    :return: list with the highest levenshtein_similarity between each keyword and its labels
+    """
+    similarities = []
+    for term, term_labels in zip(terms, labels):
+        max_sim = 0
+        if term:
+            s1, initial = normalise_term(term)
+            for l in term_labels:
+                if l and s1:
+                    s2 = normalise_label(l, initial)
+                    if not s2:
+                        continue
+                    longest = max(len(s1), len(s2))
+                    # The distance is at least the difference between the lengths, skip labels that can't be better
+                    if 1 - (abs(len(s1) - len(s2)) / longest) <= max_sim:
+                        continue
+                    sim = 1 - (Levenshtein.distance(s1, s2) / longest)
+                    if sim > max_sim:
+                        max_sim = sim
+                        if max_sim == 1:
+                            break
+        similarities.append(max_sim)
+    return similarities
+
+
 def label_from_url(url):
     return remove_brackets(unquote(url).split("/")[-1].replace("_", " "))
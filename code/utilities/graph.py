@@ -0,0 +1,107 @@
+from multiprocessing.pool import Pool
+
+from tqdm import tqdm
+
+
+def transitive_closure(nodes, adjacency):
+    """
+    :param nodes: nodes to compute the closure for
+    :param adjacency: dictionary with the list of direct neighbours of each node, e.g. the superclasses of a class
+    :return: dictionary with the frozenset of all the nodes reachable from each node
+    """
+    closure = {}
+    for node in nodes:
+        if node in closure:
+            continue
+        # Iterative post-order DFS, so the closure of the neighbours is always known before the node's
+        stack = [(node, iter(adjacency.get(node, ())))]
+        visiting = {node}
+        while stack:
+            current, neighbours = stack[-1]
+            for n in neighbours:
+                if n not in closure and n not in visiting:
+                    visiting.add(n)
+                    stack.append((n, iter(adjacency.get(n, ()))))
+                    break
+            else:
+                stack.pop()
+                visiting.discard(current)
+                reachable = set()
+                for n in adjacency.get(current, ()):
+                    reachable.add(n)
+                    reachable.update(closure.get(n, ()))
+                reachable.discard(current)
+                closure[current] = frozenset(reachable)
+    return closure
+
+
+def longest_paths(nodes, adjacency):
+    """
+    :param nodes: nodes to compute the length for
+    :param adjacency: dictionary with the list of direct neighbours of each node, e.g. the superclasses of a class
+    :return: dictionary with the number of edges of the longest path from each node, following adjacency. The edges
+    that close a cycle are not followed.
+    """
+    lengths = {}
+    for node in nodes:
+        if node in lengths:
+            continue
+        # Iterative post-order DFS, as in transitive_closure
+        stack = [(node, iter(adjacency.get(node, ())))]
+        visiting = {node}
+        while stack:
+            current, neighbours = stack[-1]
+            for n in neighbours:
+                if n not in lengths and n not in visiting:
+                    visiting.add(n)
+                    stack.append((n, iter(adjacency.get(n, ()))))
+                    break
+            else:
+                stack.pop()
+                visiting.discard(current)
+                lengths[current] = max((lengths[n] + 1 for n in adjacency.get(current, ()) if n in lengths), default=0)
+    return lengths
+
+
+def bfs(adjacency, source):
+    """Returns the number of edges between source and every node reachable from it."""
+    distances = {source: 0}
+    frontier = [source]
+    while frontier:
+        next_frontier = []
+        for node in frontier:
+            for n in adjacency.get(node, ()):
+                if n not in distances:
+                    distances[n] = distances[node] + 1
+                    next_frontier.append(n)
+        frontier = next_frontier
+    return distances
+
+
+_ADJACENCY = None
+
+
+def _init_adjacency(adjacency):
+    global _ADJACENCY
+    _ADJACENCY = adjacency
+
+
+def _eccentricity(source):
+    return source, max(bfs(_ADJACENCY, source).values())
+
+
+def eccentricities(adjacency, processes=None):
+    """
+    :param adjacency: dictionary with the set of neighbours of every node, in both directions
+    :param processes: number of processes running the BFS, None for one per core
+    :return: dictionary with the longest shortest path from each node to the nodes it reaches
+    """
+    with Pool(processes, initializer=_init_adjacency, initargs=(adjacency,)) as pool:
+        return dict(tqdm(pool.imap_unordered(_eccentricity, adjacency, chunksize=16), total=len(adjacency),
+                         desc="Eccentricities"))
+
+
+def diameter(adjacency, processes=None):
+    """Longest shortest path between two connected nodes, -1 if no two nodes are connected."""
+    longest = max(eccentricities(adjacency, processes).values(), default=0)
+    return longest if longest > 0 else -1
@@ -0,0 +1,130 @@
+import csv
+import json
+import signal
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+BUCKET_NAMES = tuple(str(b) for b in LATENCY_BUCKETS) + ("inf",)
+
+
+def _new_registry():
+    return {"time": defaultdict(float), "calls": Counter(), "counts": Counter(),
+            "histograms": defaultdict(Counter), "profile": Counter()}
+
+
+# Metrics of the current process since the last call to take
+_REGISTRY = _new_registry()
+
+
+class Timer:
+    """Adds the time spent in a block to the metrics of the process, and prints it if verbose."""
+    def __init__(self, name, verbose=False, histogram=False):
+        """
+        :param histogram: True to also count the time in the latency histogram of name
+        """
+        self.name = name
+        self.verbose = verbose
+        self.histogram = histogram
+        self.start = 0
+        self.elapsed = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        record(self.name, self.elapsed, self.histogram)
+        if self.verbose:
+            print(f"{self.name}: {self.elapsed:.4f}s")
+        return False
+
+
+def record(name, seconds, histogram=False):
+    _REGISTRY["time"][name] += seconds
+    _REGISTRY["calls"][name] += 1
+    if histogram:
+        _REGISTRY["histograms"][name][BUCKET_NAMES[bisect_left(LATENCY_BUCKETS, seconds)]] += 1
+
+
+def count(name, n=1):
+    _REGISTRY["counts"][name] += n
+
+
+def take():
+    """Returns the metrics recorded by the process since the last call and starts new ones."""
+    global _REGISTRY
+    registry = _REGISTRY
+    _REGISTRY = _new_registry()
+    return {"time": dict(registry["time"]), "calls": dict(registry["calls"]), "counts": dict(registry["counts"]),
+            "histograms": {k: dict(v) for k, v in registry["histograms"].items()},
+            "profile": dict(registry["profile"])}
+
+
+def merge(metrics, other):
+    """Adds the metrics in other to metrics."""
+    for group in ("time", "calls", "counts", "profile"):
+        values = metrics.setdefault(group, {})
+        for k, v in other.get(group, {}).items():
+            values[k] = values.get(k, 0) + v
+    histograms = metrics.setdefault("histograms", {})
+    for name, buckets in other.get("histograms", {}).items():
+        histogram = histograms.setdefault(name, {})
+        for k, v in buckets.items():
+            histogram[k] = histogram.get(k, 0) + v
+    return metrics
+
+
+def write_report(files, filename):
+    """
+    Writes the total and per-file metrics to filename.json, the time of each stage per file to filename.csv and the
+    profiler samples, if any, to filename.profile in collapsed stack format.
+    :param files: dictionary with the metrics of each file
+    """
+    total = {}
+    for metrics in files.values():
+        merge(total, metrics)
+    profile = total.pop("profile", {})
+    with open(filename + ".json", "w") as f:
+        json.dump({"total": total,
+                   "files": {k: {g: v for g, v in m.items() if g != "profile"} for k, m in files.items()}}, f,
+                  indent=1)
+
+    stages = sorted(total.get("time", {}))
+    with open(filename + ".csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file"] + stages)
+        for name, metrics in files.items():
+            writer.writerow([name] + [round(metrics["time"].get(s, 0), 6) for s in stages])
+
+    if profile:
+        with open(filename + ".profile", "w") as f:
+            for stack, samples in sorted(profile.items(), key=lambda kv: kv[1], reverse=True):
+                f.write(f"{stack} {samples}\n")
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the process every interval seconds of CPU time with SIGPROF and counts each collapsed stack
+    in the metrics of the process. It must be started from the main thread.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    @staticmethod
+    def _sample(signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(f"{frame.f_code.co_filename.split('/')[-1]}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        _REGISTRY["profile"][";".join(reversed(stack))] += 1
@@ -1,6 +1,3 @@
-from collections import defaultdict
-
-
 def init():
     global EC
     EC = None
@@ -17,9 +14,6 @@ def init():
     global DIAMETER
     DIAMETER = 0
 
-    global DISTANCES
-    DISTANCES = defaultdict(int)
-
     global PACT
     PACT = False
 
@@ -29,9 +23,23 @@ def init():
     global DISAM
     DISAM = {}
 
+    global URIS
+    URIS = None
+
     global CAT_IDF
     CAT_IDF = None
 
     global TYPES_IDF
     TYPES_IDF = None
 
+    global BATCH_SIZE
+    BATCH_SIZE = 0
+
+    global MAX_IN_FLIGHT
+    MAX_IN_FLIGHT = 0
+
+    global AEC
+    AEC = None
+
+    global LOOP
+    LOOP = None